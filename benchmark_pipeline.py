@@ -0,0 +1,273 @@
+"""Gerador de frota sintética e benchmark do pipeline do dashboard
+
+Gera workbooks no layout de 9 colunas do formulário (datas no formato
+brasileiro %d/%m/%Y %H:%M) e mede cada etapa do pipeline:
+
+    leitura do Excel -> normalização -> process_trips -> filtro -> gráficos
+
+Os tempos são comparados com baselines gravados em JSON; uma etapa mais
+lenta que baseline × tolerância é reportada como regressão (código de
+saída 1), ignorando diferenças abaixo de --min-delta. O pipeline lê
+st.secrets (snapshots, log de tempos), então rode a partir da pasta com
+.streamlit/secrets.toml.
+
+Uso:
+    python benchmark_pipeline.py --save-baseline     # grava os baselines
+    python benchmark_pipeline.py                     # compara com eles
+    python benchmark_pipeline.py --sizes 10000 --vehicles 20 --drivers 60
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+DEFAULT_BASELINE = 'benchmark_baselines.json'
+FORM_HEADER = ['Hora de início', 'Email', 'Nome', 'Placa', 'Modelo', 'Tipo', 'KM Inicial', 'KM Final', 'Finalidade']
+
+MODELOS = ['Strada', 'Hilux', 'Saveiro', 'S10', 'Toro', 'L200']
+FINALIDADES = ['Obra', 'Visita técnica', 'Manutenção', 'Administrativo', 'Entrega de material']
+NOMES = ['Ana', 'Bruno', 'Carla', 'Diego', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique', 'Isabela', 'João',
+         'Larissa', 'Marcos', 'Natália', 'Otávio', 'Paula', 'Rafael', 'Sabrina', 'Thiago', 'Vanessa', 'Wagner']
+SOBRENOMES = ['Silva', 'Souza', 'Oliveira', 'Santos', 'Pereira', 'Lima', 'Carvalho', 'Ferreira', 'Rodrigues',
+              'Almeida', 'Costa', 'Gomes', 'Martins', 'Araújo', 'Ribeiro']
+
+
+def generate_form_rows(n_events, vehicles=40, drivers=120, days=365, orphan_rate=0.01, open_rate=0.02,
+                       start=datetime(2024, 1, 1), seed=0):
+    """Respostas sintéticas do formulário, em ordem de envio
+
+    Cada viagem gera uma Saída e uma Chegada do mesmo motorista e veículo,
+    com saídas em horário comercial, duração log-normal, KM compatível com
+    a duração e hodômetro crescente por veículo, sem viagens simultâneas
+    do mesmo motorista ou veículo. Uma fração `open_rate` das viagens perde a
+    Chegada (viagem em aberto) e `orphan_rate` perde a Saída (chegada órfã).
+    """
+    rng = np.random.default_rng(seed)
+    # Folga para que o sorteio de órfãs/abertas não deixe menos de n_events linhas
+    n_trips = int(np.ceil(n_events / (2 - open_rate - orphan_rate) * 1.05)) + 10
+
+    nomes = [f"{NOMES[i % len(NOMES)]} {SOBRENOMES[(i // len(NOMES)) % len(SOBRENOMES)]} {i // 300 or ''}".strip()
+             for i in range(drivers)]
+    emails = [f"{nome.lower().replace(' ', '.')}@rezendeenergia.com.br" for nome in nomes]
+    placas = [f"{chr(65 + i % 26)}{chr(65 + i // 26 % 26)}{chr(65 + i // 676 % 26)}{i % 10}{chr(65 + i * 7 % 26)}"
+              f"{i * 13 % 100:02d}" for i in range(vehicles)]
+    modelos = rng.choice(MODELOS, vehicles)
+
+    # Cada motorista usa quase sempre o mesmo veículo
+    veiculo_habitual = rng.integers(0, vehicles, drivers)
+    motorista = rng.integers(0, drivers, n_trips)
+    veiculo = np.where(rng.random(n_trips) < 0.85, veiculo_habitual[motorista], rng.integers(0, vehicles, n_trips))
+
+    # Horário de saída ~ normal em torno das 9h30; fora das 6h–19h é sorteado de novo (uniforme)
+    hora_saida = rng.normal(9.5, 2.5, n_trips)
+    fora = (hora_saida < 6) | (hora_saida > 19)
+    hora_saida[fora] = rng.uniform(6, 19, fora.sum())
+    minuto_saida = (rng.integers(0, days, n_trips) * 1440 + hora_saida * 60).astype(np.int64)
+
+    # Duas saídas no mesmo minuto do mesmo motorista ou veículo seriam viagens sobrepostas
+    while True:
+        saidas = pd.DataFrame({'motorista': motorista, 'veiculo': veiculo, 'minuto': minuto_saida})
+        repetida = (saidas.duplicated(['motorista', 'minuto']) | saidas.duplicated(['veiculo', 'minuto'])).to_numpy()
+        if not repetida.any():
+            break
+        minuto_saida[repetida] += rng.integers(1, 30, repetida.sum())
+    duracao = np.clip(rng.lognormal(np.log(90), 0.7, n_trips), 10, 720).astype(np.int64)
+
+    # Nem o motorista nem o veículo começam outra viagem antes de chegar da anterior
+    for quem in (motorista, veiculo):
+        order = np.lexsort((minuto_saida, quem))
+        proxima = np.r_[minuto_saida[order][1:], np.iinfo(np.int64).max]
+        mesmo = np.r_[quem[order][1:] == quem[order][:-1], False]
+        limite = np.where(mesmo, proxima - minuto_saida[order] - 1, duracao[order])
+        duracao[order] = np.maximum(1, np.minimum(duracao[order], limite))
+
+    # KM pela duração e uma velocidade média plausível
+    velocidade = np.clip(rng.normal(35, 12, n_trips), 8, 90)
+    km_viagem = np.maximum(1, duracao * velocidade / 60).round().astype(np.int64)
+
+    # Hodômetro acumulado por veículo na ordem das saídas
+    order = np.lexsort((minuto_saida, veiculo))
+    km_acumulado = np.empty(n_trips, dtype=np.int64)
+    cumsum = np.cumsum(km_viagem[order])
+    inicio_grupo = np.r_[0, np.flatnonzero(np.diff(veiculo[order])) + 1]
+    base = np.repeat(cumsum[inicio_grupo] - km_viagem[order][inicio_grupo], np.diff(np.r_[inicio_grupo, n_trips]))
+    km_acumulado[order] = cumsum - base - km_viagem[order]
+    km_inicial = 20000 + veiculo * 1000 + km_acumulado
+    km_final = km_inicial + km_viagem
+
+    sorteio = rng.random(n_trips)
+    tem_saida = sorteio >= orphan_rate
+    tem_chegada = sorteio < 1 - open_rate
+    finalidade = rng.choice(FINALIDADES, n_trips, p=[0.35, 0.25, 0.15, 0.15, 0.10])
+
+    saidas = np.flatnonzero(tem_saida)
+    chegadas = np.flatnonzero(tem_chegada)
+    viagem = np.concatenate([saidas, chegadas])
+    is_saida = np.r_[np.ones(len(saidas), bool), np.zeros(len(chegadas), bool)]
+    minuto = np.where(is_saida, minuto_saida[viagem], minuto_saida[viagem] + duracao[viagem])
+
+    order = np.argsort(minuto, kind='stable')[:n_events]
+    viagem, is_saida, minuto = viagem[order], is_saida[order], minuto[order]
+
+    data_hora = pd.Timestamp(start) + pd.to_timedelta(minuto, unit='m')
+    return pd.DataFrame({
+        FORM_HEADER[0]: data_hora.strftime('%d/%m/%Y %H:%M'),
+        FORM_HEADER[1]: np.asarray(emails)[motorista[viagem]],
+        FORM_HEADER[2]: np.asarray(nomes)[motorista[viagem]],
+        FORM_HEADER[3]: np.asarray(placas)[veiculo[viagem]],
+        FORM_HEADER[4]: modelos[veiculo[viagem]],
+        FORM_HEADER[5]: np.where(is_saida, 'Saída', 'Chegada'),
+        FORM_HEADER[6]: np.where(is_saida, km_inicial[viagem], np.nan),
+        FORM_HEADER[7]: np.where(is_saida, np.nan, km_final[viagem]),
+        FORM_HEADER[8]: np.where(is_saida, finalidade[viagem], None),
+    })
+
+
+def write_workbook(rows, target):
+    """Gravar as linhas em xlsx com xlsxwriter (constant_memory); target é caminho ou arquivo"""
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Form1')
+    worksheet.write_row(0, 0, list(rows.columns))
+
+    for row_number, values in enumerate(rows.itertuples(index=False, name=None), start=1):
+        for column, value in enumerate(values):
+            if value is not None and value == value:
+                worksheet.write(row_number, column, value)
+
+    workbook.close()
+
+
+def best_of(repeats, func, *args):
+    """Menor tempo de `repeats` execuções e o último resultado"""
+    best = float('inf')
+    for _ in range(repeats):
+        started = time.perf_counter()
+        result = func(*args)
+        best = min(best, time.perf_counter() - started)
+    return best, result
+
+
+def run_pipeline(app, path, repeats):
+    """Tempos (s) de cada etapa do pipeline para o workbook em `path`"""
+    timings = {}
+
+    with open(path, 'rb') as f:
+        timings['excel_parse'], batches = best_of(1, lambda: list(app.iter_workbook_batches(f)))
+
+    timings['normalizacao'], events = best_of(1, lambda: app.apply_schema(
+        pd.concat([app.normalize_events(batch) for batch in batches], ignore_index=True), app.EVENT_SCHEMA))
+    timings['process_trips'], (trips, _) = best_of(1, app.build_trips, events)
+    timings['consistencia'], _ = best_of(repeats, app.check_consistency, events, trips)
+
+    # Janela dos últimos 30 dias com todos os motoristas (None), como o filtro padrão do main()
+    data_fim = trips['data_saida'].max().date()
+    data_inicio = data_fim - timedelta(days=30)
+    motoristas = None
+    status = ['Completa', 'Em Aberto']
+    timings['filtro'], filtered = best_of(repeats, app.filter_trips, trips, data_inicio, data_fim, motoristas, status)
+    fim = pd.Timestamp(data_fim) + pd.Timedelta(days=1)
+
+    def utilization():
+        selected, ends = app.utilization_trips(trips, proxima_saida, pd.Timestamp(data_inicio), fim, fim,
+                                               motoristas, status)
+        return app.fleet_utilization(selected, pd.Timestamp(data_inicio), fim, fim, ends)
+
+    timings['proxima_saida'], proxima_saida = best_of(1, app.next_departures, trips)
+    timings['utilizacao'], _ = best_of(repeats, utilization)
+
+    def chart_prep():
+        slices = app.slice_rollups(rollups, data_inicio, data_fim, motoristas, status, filtered)
+        return app.chart_data(slices, app.time_bucket(data_inicio, data_fim)[0])
+
+    timings['agregados'], rollups = best_of(1, app.build_rollups, trips)
+    timings['indice_kpi'], kpi_index = best_of(1, app.build_kpi_index, trips)
+    timings['kpis'], _ = best_of(repeats, app.kpi_window, kpi_index, data_inicio, data_fim, motoristas, status)
+    timings['graficos'], charts = best_of(repeats, chart_prep)
+    timings['figuras'], _ = best_of(repeats, app.build_figures, charts, 'Dia')
+
+    # Histórico do veículo mais usado, achado por prefixo da placa no índice invertido
+    def drill_down():
+        app.search_trip_index(trip_index, placa[:3])
+        return trips.iloc[app.trip_positions(trip_index, 'placa', placa)]
+
+    placa = trips['placa'].value_counts().index[0]
+    timings['indice_busca'], trip_index = best_of(1, app.build_trip_index, trips)
+    timings['historico'], _ = best_of(repeats, drill_down)
+
+    return timings, {'eventos': len(events), 'viagens': len(trips)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='eventos por workbook')
+    parser.add_argument('--vehicles', type=int, default=40)
+    parser.add_argument('--drivers', type=int, default=120)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--orphan-rate', type=float, default=0.01)
+    parser.add_argument('--open-rate', type=float, default=0.02)
+    parser.add_argument('--repeats', type=int, default=5, help='repetições das etapas rápidas (filtro/gráficos)')
+    parser.add_argument('--workdir', default='.bench', help='pasta dos workbooks gerados')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true', help='gravar os tempos como novo baseline')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='fator acima do baseline que é regressão')
+    parser.add_argument('--min-delta', type=float, default=0.005,
+                        help='diferença mínima (s) para contar como regressão; evita ruído de etapas de milissegundos')
+    args = parser.parse_args()
+
+    import controledeentradaesaidaveiculos as app
+
+    os.makedirs(args.workdir, exist_ok=True)
+    baselines = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    for size in args.sizes:
+        name = (f"frota_{size}_{args.vehicles}v_{args.drivers}m_{args.days}d_"
+                f"{args.orphan_rate}o_{args.open_rate}a.xlsx")
+        path = os.path.join(args.workdir, name)
+        if not os.path.exists(path):
+            print(f"gerando {path} ...", flush=True)
+            rows = generate_form_rows(size, args.vehicles, args.drivers, args.days, args.orphan_rate, args.open_rate)
+            write_workbook(rows, path)
+
+        timings, counts = run_pipeline(app, path, args.repeats)
+        print(f"\n{size:,} eventos ({counts['viagens']:,} viagens)")
+
+        baseline = baselines.get(str(size), {})
+        for stage, seconds in timings.items():
+            reference = baseline.get(stage)
+            note = ''
+            if reference:
+                ratio = seconds / reference
+                note = f"  baseline {reference:8.3f}s  x{ratio:.2f}"
+                if ratio > args.tolerance and seconds - reference > args.min_delta:
+                    note += '  REGRESSÃO'
+                    regressions.append((size, stage, ratio))
+            print(f"  {stage:<14} {seconds:8.3f}s{note}")
+
+        if args.save_baseline:
+            baselines[str(size)] = timings
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(baselines, f, indent=2)
+        print(f"\nbaseline gravado em {args.baseline}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regressão(ões) acima de x{args.tolerance}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,29 @@
 import streamlit as st
 import pandas as pd
-import plotly.express as px
-import plotly.graph_objects as go
 import numpy as np
 from datetime import datetime, timedelta
+import codecs
+import collections
+import contextlib
+import fnmatch
+import functools
+import hashlib
 import io
-
-# Configuração da página
-st.set_page_config(
-    page_title=st.secrets.get("app", {}).get("page_title", "Controle de Veículos"),
-    page_icon="🚗",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 # CSS customizado com as cores da empresa
-st.markdown("""
+PAGE_CSS = """
 <style>
     @import url('https://fonts.googleapis.com/css2?family=Inter:wght@300;400;500;600;700&display=swap');
 
@@ -141,173 +149,1938 @@ st.markdown("""
     }
 
 </style>
-""", unsafe_allow_html=True)
+"""
+
+
+# Layout do formulário no SharePoint e formato padrão dos eventos
+SOURCE_COLUMNS = ['data_hora', 'email', 'nome', 'placa', 'modelo', 'tipo', 'km_inicial', 'km_final', 'finalidade']
+DATA_HORA_FORMAT = '%d/%m/%Y %H:%M'
+
+# Tipos compactos: rótulos repetidos como category, hodômetro em Int32 e
+# durações em float32
+EVENT_SCHEMA = {
+    'data_hora': 'datetime64', 'email': 'category', 'nome': 'category', 'placa': 'category',
+    'modelo': 'category', 'tipo': 'category', 'km': 'Int32', 'finalidade': 'category',
+}
+EVENT_COLUMNS = list(EVENT_SCHEMA)
+
+# Colunas de saída do pareamento de viagens
+TRIP_SCHEMA = {
+    'motorista': 'category', 'email': 'category', 'placa': 'category', 'modelo': 'category',
+    'data_saida': 'datetime64',
+    'data_chegada': 'datetime64', 'km_inicial': 'Int32', 'km_final': 'Int32', 'km_rodados': 'Int32',
+    'tempo_viagem': 'float32', 'finalidade': 'category', 'status': 'category',
+}
+TRIP_COLUMNS = list(TRIP_SCHEMA)
+TRIP_STATUS = ['Completa', 'Em Aberto']
+
+ORPHAN_SCHEMA = {
+    'motorista': 'category', 'placa': 'category', 'modelo': 'category', 'data_chegada': 'datetime64',
+    'km_final': 'Int32', 'status': 'category',
+}
+ORPHAN_COLUMNS = list(ORPHAN_SCHEMA)
+
+# Estado do pareamento: último evento de cada (nome, placa) e a Saída pendente
+PAIRING_SCHEMA = {'nome': 'category', 'placa': 'category', 'last_seen': 'datetime64', 'open_pos': 'int64'}
+PAIRING_COLUMNS = list(PAIRING_SCHEMA)
+
+
+def apply_schema(df, schema):
+    """Converter as colunas do frame para os tipos do esquema"""
+    columns = {}
+    for column, dtype in schema.items():
+        values = df[column]
+        if dtype == 'datetime64':
+            values = values if pd.api.types.is_datetime64_any_dtype(values) else pd.to_datetime(values)
+        elif dtype == 'Int32':
+            values = pd.to_numeric(values, errors='coerce').round().astype('Int32')
+        else:
+            values = values.astype(dtype)
+        columns[column] = values
+    return pd.DataFrame(columns, index=df.index)
+
+
+def concat_typed(frames, schema):
+    """Concatenar frames já tipados sem passar por object
+
+    As categorias de cada coluna viram a união ordenada das categorias dos
+    frames (como as que apply_schema monta), em vez de o concat devolver
+    object e o esquema ter de ser reaplicado sobre o frame inteiro. A
+    ordenação das tabelas por categoria segue, assim, alfabética.
+    """
+    frames = list(frames)
+    for column, dtype in schema.items():
+        if dtype != 'category':
+            continue
+        categories = frames[0][column].cat.categories
+        for frame in frames[1:]:
+            categories = categories.union(frame[column].cat.categories, sort=False)
+        categories = categories.sort_values()
+        frames = [frame if frame[column].cat.categories.equals(categories)
+                  else frame.assign(**{column: frame[column].cat.set_categories(categories)})
+                  for frame in frames]
+    return pd.concat(frames, ignore_index=True)
+
+
+def parse_data_hora(values):
+    """Converter a coluna data_hora para datetime64 (no-op se já convertida)"""
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    return pd.to_datetime(values, format=DATA_HORA_FORMAT)
+
+
+def normalize_events(df):
+    """Converter as linhas do formulário para o formato padrão de eventos
+
+    Trabalha em colunas inteiras: `km` e `finalidade` são escolhidos pelo
+    `tipo` com máscaras, `data_hora` é convertido uma única vez e o
+    resultado já sai nos tipos compactos de EVENT_SCHEMA.
+    """
+    df = df.set_axis(SOURCE_COLUMNS, axis=1).reset_index(drop=True)
+    is_saida = df['tipo'] == 'Saída'
+
+    return apply_schema(pd.DataFrame({
+        'data_hora': parse_data_hora(df['data_hora']),
+        'email': df['email'],
+        'nome': df['nome'],
+        'placa': df['placa'],
+        'modelo': df['modelo'],
+        'tipo': np.where(is_saida, 'Saída', 'Chegada'),
+        'km': df['km_inicial'].where(is_saida, df['km_final']),
+        'finalidade': df['finalidade'].where(is_saida, None),
+    }), EVENT_SCHEMA)
+
+
+# Snapshots em disco (Arrow IPC), chaveados pelo hash do conteúdo da origem
+SNAPSHOT_VERSION = 3
+SNAPSHOTS_KEPT = 3
+SNAPSHOT_MARKER_PATTERN = re.compile(r'[0-9a-f]{12}')  # nome das pastas de cada esquema
+
+
+def snapshot_schema_marker():
+    """Marcador de versão: muda junto com as colunas e tipos persistidos"""
+    schema = [SNAPSHOT_VERSION, EVENT_SCHEMA, TRIP_SCHEMA, ORPHAN_SCHEMA, PAIRING_SCHEMA]
+    return hashlib.sha1(json.dumps(schema).encode()).hexdigest()[:12]
+
+
+def snapshot_path(key):
+    base_dir = st.secrets.get("cache", {}).get("snapshot_dir", ".snapshots")
+    return os.path.join(base_dir, snapshot_schema_marker(), key)
+
+
+def source_key(item):
+    """Chave do snapshot a partir do hash de conteúdo informado pelo Graph"""
+    hashes = item.get('file', {}).get('hashes', {})
+    content_hash = (hashes.get('quickXorHash') or hashes.get('sha256Hash') or hashes.get('sha1Hash')
+                    or item.get('cTag'))
+    return hashlib.sha1(f"{item['id']}:{content_hash}".encode()).hexdigest()
+
+
+def load_snapshot(key, names):
+    """Ler os frames salvos para a chave (memory-mapped); None se faltar algum"""
+    from pyarrow import feather
+
+    path = snapshot_path(key)
+    try:
+        with open(os.path.join(path, 'manifest.json')) as f:
+            manifest = json.load(f)
+        frames = {name: feather.read_table(os.path.join(path, f'{name}.arrow'), memory_map=True).to_pandas()
+                  for name in names}
+    except (OSError, ValueError):
+        return None
+
+    return frames, manifest
 
 
-@st.cache_data
-def load_sharepoint_data():
-    """Carregar dados reais do SharePoint"""
+def save_snapshot(key, frames, **manifest):
+    """Gravar frames para a chave, preservando os já salvos e o manifesto
+
+    O snapshot é só cache: uma falha de disco vira aviso no log e o app
+    segue com os frames em memória.
+    """
+    from pyarrow import feather
+
+    path = snapshot_path(key)
+    try:
+        os.makedirs(path, exist_ok=True)
+
+        for name, frame in frames.items():
+            tmp_path = os.path.join(path, f'{name}.arrow.tmp')
+            feather.write_feather(frame, tmp_path, compression='uncompressed')
+            os.replace(tmp_path, os.path.join(path, f'{name}.arrow'))
+
+        manifest_path = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                manifest = {**json.load(f), **manifest}
+        with open(f'{manifest_path}.tmp', 'w') as f:
+            json.dump({**manifest, 'schema': snapshot_schema_marker()}, f)
+        os.replace(f'{manifest_path}.tmp', manifest_path)
+
+        # Snapshots de outras versões do esquema ficam obsoletos; só entradas com
+        # cara de marcador são apagadas, snapshot_dir pode ser uma pasta compartilhada
+        base_dir = os.path.dirname(os.path.dirname(path))
+        for marker in os.listdir(base_dir):
+            marker_dir = os.path.join(base_dir, marker)
+            if (marker != snapshot_schema_marker() and SNAPSHOT_MARKER_PATTERN.fullmatch(marker)
+                    and os.path.isdir(marker_dir)):
+                shutil.rmtree(marker_dir, ignore_errors=True)
+    except OSError as exc:
+        logger.warning("não foi possível gravar o snapshot %s: %s", key, exc)
+
+
+def prune_snapshots(active_keys):
+    """Apagar snapshots fora de uso, mantendo os SNAPSHOTS_KEPT mais recentes além dos ativos"""
+    schema_dir = os.path.dirname(snapshot_path('_'))
     try:
-        # Importar sua função de acesso ao SharePoint
+        if not os.path.isdir(schema_dir):
+            return
+
+        keys = [key for key in os.listdir(schema_dir) if key not in active_keys]
+        keys.sort(key=lambda k: os.path.getmtime(os.path.join(schema_dir, k)))
+        for old_key in keys[:-SNAPSHOTS_KEPT]:
+            shutil.rmtree(os.path.join(schema_dir, old_key), ignore_errors=True)
+    except OSError as exc:
+        logger.warning("não foi possível limpar os snapshots antigos: %s", exc)
+
+
+GRAPH_BASE_URL = "https://graph.microsoft.com/v1.0"
+GRAPH_SCOPES = ["https://graph.microsoft.com/.default"]
+GRAPH_TIMEOUT = (5, 60)  # (conexão, leitura) em segundos
+GRAPH_MAX_RETRIES = 4
+GRAPH_ID_TTL = 3600  # segundos
+
+logger = logging.getLogger("controle_veiculos")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# Spans de tempo por etapa (token, site, busca, download, leitura, normalização, ...)
+TIMING_SPANS_KEPT = 2000
+TIMING_LOG_MAX_BYTES = 10 << 20
+
+
+class TimingRecorder:
+    """Spans de tempo por etapa do pipeline
+
+    Os últimos TIMING_SPANS_KEPT spans ficam em memória para o painel de
+    depuração; cada span também vai como uma linha JSON para `log_path`
+    (arquivo rotativo), para acompanhar p50/p95 entre sessões.
+    """
+
+    def __init__(self, log_path=None):
+        self.spans = collections.deque(maxlen=TIMING_SPANS_KEPT)
+        self._lock = threading.Lock()
+        self._log = None
+
+        if log_path:
+            os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+            handler = logging.handlers.RotatingFileHandler(log_path, maxBytes=TIMING_LOG_MAX_BYTES, backupCount=3,
+                                                           encoding='utf-8')
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            self._log = logging.getLogger(f"controle_veiculos.timings.{id(self)}")
+            self._log.addHandler(handler)
+            self._log.setLevel(logging.INFO)
+            self._log.propagate = False
+
+    def record(self, stage, seconds, **fields):
+        span = {'ts': datetime.now().isoformat(timespec='milliseconds'), 'stage': stage,
+                'ms': round(seconds * 1000, 2), 'pid': os.getpid(), **fields}
+        with self._lock:
+            self.spans.append(span)
+        if self._log:
+            self._log.info(json.dumps(span, ensure_ascii=False, default=str))
+
+    @contextlib.contextmanager
+    def span(self, stage, **fields):
+        """Medir o bloco; campos (rows, bytes, ...) podem ser preenchidos no dict devolvido"""
+        started = time.perf_counter()
+        try:
+            yield fields
+        finally:
+            self.record(stage, time.perf_counter() - started, **fields)
+
+    def summary(self):
+        """Última duração, p50, p95 e contagem por etapa dos spans em memória"""
+        with self._lock:
+            spans = pd.DataFrame(list(self.spans))
+        if spans.empty:
+            return spans
+        if 'chart' in spans:
+            spans['stage'] = spans['stage'].where(spans['chart'].isna(), spans['stage'] + ':' + spans['chart'])
+
+        grouped = spans.groupby('stage', sort=False)
+        summary = pd.DataFrame({
+            'Última (ms)': grouped['ms'].last(),
+            'p50 (ms)': grouped['ms'].quantile(0.5),
+            'p95 (ms)': grouped['ms'].quantile(0.95),
+            'Execuções': grouped.size(),
+        })
+        for column, label in [('rows', 'Linhas'), ('bytes', 'Bytes')]:
+            if column in spans:
+                summary[label] = grouped[column].last().astype('Int64')
+        return summary.round(1).rename_axis('Etapa').reset_index()
+
+
+@st.cache_resource
+def timing_recorder():
+    """Registro de spans do processo; [debug] timing_log = "" desliga o arquivo"""
+    return TimingRecorder(st.secrets.get("debug", {}).get("timing_log", ".logs/timings.jsonl"))
+
+
+# Threads de fundo não chamam st.*: recebem o registro ao iniciar
+_thread_timings = threading.local()
+
+
+def get_timings():
+    return getattr(_thread_timings, 'recorder', None) or timing_recorder()
+
+
+def set_thread_timings(recorder):
+    """Inicializador de threads de fundo (worker e pool de fontes)"""
+    _thread_timings.recorder = recorder
+
+
+def timed(stage, **fields):
+    return get_timings().span(stage, **fields)
+
+
+class GraphClient:
+    """Cliente do Microsoft Graph compartilhado entre sessões
+
+    Mantém uma requests.Session com pool de conexões keep-alive, aplica
+    timeout a toda chamada, repete respostas 429/503 respeitando o
+    Retry-After e memoriza por GRAPH_ID_TTL os ids de site e item.
+    `acquire_token` devolve o resultado no formato do MSAL; o
+    ConfidentialClientApplication reaproveita o token em cache até expirar.
+    """
+
+    def __init__(self, acquire_token, base_url=GRAPH_BASE_URL):
         import requests
+        from requests.adapters import HTTPAdapter
+
+        self.base_url = base_url
+        self._acquire_token = acquire_token
+        self._ids = {}
+        self._lock = threading.Lock()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def headers(self):
+        """Cabeçalho de autorização, ou None se não houver token"""
+        started = time.perf_counter()
+        result = self._acquire_token()
+        source = result.get("token_source", "?")
+        elapsed = time.perf_counter() - started
+        get_timings().record('token', elapsed, source=source)
+        logger.log(logging.DEBUG if source == "cache" else logging.INFO, "token (%s) em %.0f ms", source,
+                   elapsed * 1000)
+
+        if "access_token" not in result:
+            logger.warning("falha ao obter token: %s", result.get("error_description", result.get("error")))
+            return None
+        return {"Authorization": f"Bearer {result['access_token']}"}
+
+    def get(self, url, headers=None, stream=False):
+        """GET autenticado com timeout e nova tentativa em 429/503"""
+        request_headers = self.headers() or {}
+        request_headers.update(headers or {})
+
+        for attempt in range(GRAPH_MAX_RETRIES + 1):
+            started = time.perf_counter()
+            response = self.session.get(url, headers=request_headers, timeout=GRAPH_TIMEOUT, stream=stream)
+            logger.info("GET %s -> %s em %.0f ms", url.removeprefix(self.base_url), response.status_code,
+                        (time.perf_counter() - started) * 1000)
+
+            if response.status_code not in (429, 503) or attempt == GRAPH_MAX_RETRIES:
+                return response
+
+            retry_after = response.headers.get("Retry-After", "")
+            delay = float(retry_after) if retry_after.isdigit() else 2 ** attempt
+            response.close()
+            logger.warning("Graph limitou a requisição (%s); nova tentativa em %.0f s", response.status_code, delay)
+            time.sleep(delay)
+
+    def memoized(self, key, resolve):
+        """Valor de resolve() guardado por GRAPH_ID_TTL (None não é guardado)"""
+        with self._lock:
+            cached = self._ids.get(key)
+        if cached is not None and cached[1] > time.monotonic():
+            return cached[0]
+
+        value = resolve()
+        if value is not None:
+            with self._lock:
+                self._ids[key] = (value, time.monotonic() + GRAPH_ID_TTL)
+        return value
+
+    def forget(self, key):
+        with self._lock:
+            self._ids.pop(key, None)
+
+    def site_id(self, site_url_base, site_path):
+        """Id do site do SharePoint"""
+        def resolve():
+            with timed('site'):
+                response = self.get(f"{self.base_url}/sites/{site_url_base}:{site_path}")
+            return response.json()['id'] if response.status_code == 200 else None
+
+        return self.memoized(('site', site_url_base, site_path), resolve)
+
+    def find_items(self, site_id, pattern):
+        """(id, nome) dos arquivos da biblioteca cujo nome é `pattern` ou casa com o glob"""
+        def resolve():
+            # A busca do Graph é textual: consultar pelo maior trecho literal e filtrar pelo glob
+            query = max(re.split(r"[*?\[\]]", pattern), key=len)
+            url = f"{self.base_url}/sites/{site_id}/drive/root/search(q='{query}')"
+            found = []
+            with timed('busca'):
+                while url:
+                    response = self.get(url)
+                    if response.status_code != 200:
+                        return None
+                    payload = response.json()
+                    found += [(item['id'], item['name']) for item in payload.get('value', [])
+                              if fnmatch.fnmatchcase(item['name'], pattern)]
+                    url = payload.get('@odata.nextLink')
+            return sorted(found, key=lambda item: item[1]) or None
+
+        return self.memoized(('items', site_id, pattern), resolve)
+
+
+@st.cache_resource
+def get_graph_client():
+    """GraphClient do processo, com a aplicação MSAL criada uma única vez
+
+    Construir o ConfidentialClientApplication já busca a configuração
+    OpenID do tenant pela rede, então ele só é criado no primeiro pedido de
+    token, na thread do worker. Uma falha ali vira erro da busca e a
+    próxima tentativa cria de novo (functools.cache não guarda exceções).
+    """
+    sharepoint = st.secrets["sharepoint"]
+    client_id, tenant_id, client_secret = (
+        sharepoint["client_id"], sharepoint["tenant_id"], sharepoint["client_secret"])
+
+    @functools.cache
+    def msal_app():
         from msal import ConfidentialClientApplication
 
-        # Carregar credenciais do secrets.toml
-        client_id = st.secrets["sharepoint"]["client_id"]
-        client_secret = st.secrets["sharepoint"]["client_secret"]
-        tenant_id = st.secrets["sharepoint"]["tenant_id"]
-        site_url_base = st.secrets["sharepoint"]["site_url"]
-        site_path = st.secrets["sharepoint"]["site_path"]
-        excel_filename = st.secrets["sharepoint"]["excel_filename"]
-
-        # Configurar autenticação
-        app = ConfidentialClientApplication(
+        return ConfidentialClientApplication(
             client_id,
             authority=f"https://login.microsoftonline.com/{tenant_id}",
             client_credential=client_secret,
         )
 
-        # Obter token
-        result = app.acquire_token_for_client(scopes=["https://graph.microsoft.com/.default"])
-
-        if "access_token" in result:
-            headers = {"Authorization": f"Bearer {result['access_token']}"}
-
-            # Obter o site_id
-            site_url = f"https://graph.microsoft.com/v1.0/sites/{site_url_base}:{site_path}"
-            site_response = requests.get(site_url, headers=headers)
-
-            if site_response.status_code == 200:
-                site_data = site_response.json()
-                site_id = site_data['id']
-
-                # Buscar o arquivo específico
-                search_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/root/search(q='{excel_filename}')"
-                search_response = requests.get(search_url, headers=headers)
-
-                if search_response.status_code == 200:
-                    search_data = search_response.json()
-                    files_found = search_data.get('value', [])
-
-                    for item in files_found:
-                        if item['name'] == excel_filename:
-                            # Baixar o arquivo
-                            download_url = f"https://graph.microsoft.com/v1.0/sites/{site_id}/drive/items/{item['id']}/content"
-                            download_response = requests.get(download_url, headers=headers)
-
-                            if download_response.status_code == 200:
-                                # Ler o Excel
-                                df = pd.read_excel(io.BytesIO(download_response.content))
-
-                                # Padronizar nomes das colunas
-                                df.columns = ['data_hora', 'email', 'nome', 'placa', 'modelo', 'tipo', 'km_inicial',
-                                              'km_final', 'finalidade']
-
-                                # Processar dados para formato padrão
-                                processed_data = []
-                                for _, row in df.iterrows():
-                                    if row['tipo'] == 'Saída':
-                                        processed_data.append({
-                                            'data_hora': row['data_hora'],
-                                            'email': row['email'],
-                                            'nome': row['nome'],
-                                            'placa': row['placa'],
-                                            'modelo': row['modelo'],
-                                            'tipo': 'Saída',
-                                            'km': row['km_inicial'],
-                                            'finalidade': row['finalidade']
-                                        })
-                                    else:  # Chegada
-                                        processed_data.append({
-                                            'data_hora': row['data_hora'],
-                                            'email': row['email'],
-                                            'nome': row['nome'],
-                                            'placa': row['placa'],
-                                            'modelo': row['modelo'],
-                                            'tipo': 'Chegada',
-                                            'km': row['km_final'],
-                                            'finalidade': None
-                                        })
-
-                                return pd.DataFrame(processed_data)
-
-        st.error("Erro ao acessar o SharePoint. Verifique as credenciais.")
-        return pd.DataFrame()
+    return GraphClient(
+        lambda: msal_app().acquire_token_for_client(scopes=GRAPH_SCOPES),
+        base_url=sharepoint.get("graph_base_url", GRAPH_BASE_URL),
+    )
+
+
+@st.cache_resource
+def get_sync_state():
+    """Estado da sincronização dos workbooks (um por item), compartilhado pelo processo"""
+    return {'lock': threading.Lock(), 'items': {}}
+
+
+# Leitura em fluxo do workbook
+DOWNLOAD_CHUNK_SIZE = 1 << 20
+SPOOL_MAX_SIZE = 32 << 20
+READ_BATCH_ROWS = 20000
+KM_SOURCE_COLUMNS = ['km_inicial', 'km_final']
+
+
+def download_workbook(client, url):
+    """Baixar o arquivo em blocos para um arquivo temporário (memória limitada)"""
+    with timed('download', bytes=0) as span, client.get(url, stream=True) as response:
+        if response.status_code != 200:
+            return None
+
+        spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+        for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            spool.write(chunk)
+            span['bytes'] += len(chunk)
+
+    spool.seek(0)
+    return spool
+
+
+def iter_workbook_batches(file, batch_rows=READ_BATCH_ROWS):
+    """Gerar as linhas da primeira planilha em DataFrames de até batch_rows linhas
+
+    Usa openpyxl em modo read_only, sem montar a planilha inteira. Linhas
+    vazias são ignoradas, como no pd.read_excel; as colunas de KM viram
+    float e as demais ficam como object para que todos os lotes tenham os
+    mesmos tipos.
+    """
+    from openpyxl import load_workbook
+
+    workbook = load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        width = len(SOURCE_COLUMNS)
+        next(rows, None)  # cabeçalho
+
+        while True:
+            batch = [row[:width] + (None,) * (width - len(row))
+                     for row in itertools.islice(rows, batch_rows)]
+            if not batch:
+                break
+
+            df = pd.DataFrame.from_records(batch, columns=SOURCE_COLUMNS).astype(object)
+            df = df[df.notna().any(axis=1)].reset_index(drop=True)
+            for column in KM_SOURCE_COLUMNS:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+            yield df
+    finally:
+        workbook.close()
+
+
+def read_workbook_events(file, skip_rows=0):
+    """Ler o workbook em lotes, normalizando apenas as linhas após skip_rows
+
+    Retorna (eventos, linhas lidas, hash de todas as linhas, hash das
+    primeiras skip_rows linhas).
+    """
+    parts = []
+    rows_seen = rows_hash = prefix_hash = 0
+    started = time.perf_counter()
+    normalizing = 0.0  # leitura e normalização se intercalam; separar os tempos
+
+    for batch in iter_workbook_batches(file):
+        hashes = pd.util.hash_pandas_object(batch, index=False).to_numpy()
+        in_prefix = min(len(batch), max(0, skip_rows - rows_seen))
+
+        prefix_hash += int(hashes[:in_prefix].sum(dtype=np.uint64))
+        rows_hash += int(hashes.sum(dtype=np.uint64))
+        rows_seen += len(batch)
+
+        if in_prefix < len(batch):
+            normalize_started = time.perf_counter()
+            parts.append(normalize_events(batch.iloc[in_prefix:]))
+            normalizing += time.perf_counter() - normalize_started
+
+    normalize_started = time.perf_counter()
+    if parts:
+        events = concat_typed(parts, EVENT_SCHEMA)
+    else:
+        events = normalize_events(pd.DataFrame(columns=SOURCE_COLUMNS))
+    normalizing += time.perf_counter() - normalize_started
+
+    timings = get_timings()
+    timings.record('excel_parse', time.perf_counter() - started - normalizing, rows=rows_seen)
+    timings.record('normalizacao', normalizing, rows=len(events))
+    return events, rows_seen, rows_hash % 2 ** 64, prefix_hash % 2 ** 64
+
+
+def sync_workbook(client, item_url, state):
+    """Sincronizar os eventos locais com o item do workbook no SharePoint
+
+    Os metadados do item são consultados com If-None-Match; o conteúdo só é
+    baixado quando o cTag muda e não há snapshot em disco para o mesmo
+    conteúdo. O formulário apenas acrescenta linhas, então se as linhas já
+    vistas continuam iguais só as novas são normalizadas e anexadas.
+    Qualquer outra alteração (edição, exclusão) refaz tudo.
+    Retorna None se o item não puder ser lido.
+    """
+    with state['lock']:
+        events = state.get('events')
+
+        # Consultar metadados do item (eTag/cTag/lastModifiedDateTime)
+        meta_headers = {}
+        if events is not None and state.get('etag'):
+            meta_headers['If-None-Match'] = state['etag']
+        meta_response = client.get(item_url, headers=meta_headers)
+
+        if meta_response.status_code == 304:
+            return events
+        if meta_response.status_code != 200:
+            return None
+
+        item = meta_response.json()
+        if events is not None and item.get('cTag') == state.get('ctag'):
+            state['etag'] = item.get('eTag')
+            return events
+
+        key = source_key(item)
+        snapshot = load_snapshot(key, ['events'])
+
+        if snapshot is not None:
+            # Mesmo conteúdo já normalizado em disco (ex.: após reiniciar o servidor)
+            frames, manifest = snapshot
+            events = frames['events']
+            rows_seen, rows_hash = manifest['rows_seen'], manifest['rows_hash']
+        else:
+            # Conteúdo mudou: baixar o arquivo em blocos e ler em lotes
+            spool = download_workbook(client, f"{item_url}/content")
+            if spool is None:
+                return None
+
+            with spool:
+                seen = state.get('rows_seen', 0) if events is not None else 0
+                new_events, rows_seen, rows_hash, prefix_hash = read_workbook_events(spool, skip_rows=seen)
+
+                if seen and rows_seen >= seen and prefix_hash == state['rows_hash']:
+                    # Apenas linhas acrescentadas desde a última sincronização; o
+                    # pareamento de viagens pode continuar a partir da versão anterior
+                    appended_to = (events.attrs.get('source_hash'), len(events))
+                    events = concat_typed([events, new_events], EVENT_SCHEMA)
+                    events.attrs = {'appended_to': appended_to}
+                else:
+                    if seen:
+                        # Linhas antigas mudaram: normalizar o arquivo inteiro
+                        spool.seek(0)
+                        new_events, rows_seen, rows_hash, _ = read_workbook_events(spool)
+                    events = new_events
+
+            save_snapshot(key, {'events': events}, rows_seen=rows_seen, rows_hash=rows_hash)
+
+        events.attrs['source_hash'] = key
+        state.update(
+            events=events,
+            rows_seen=rows_seen,
+            rows_hash=rows_hash,
+            etag=item.get('eTag'),
+            ctag=item.get('cTag'),
+            last_modified=item.get('lastModifiedDateTime'),
+            watermark=events['data_hora'].max() if not events.empty else None,
+        )
+        return events
+
+
+# Várias fontes (site + nome ou glob), sincronizadas em paralelo
+SOURCE_WORKERS = 4
+SOURCE_COLUMN = 'origem'
+MERGED_EVENT_SCHEMA = {**EVENT_SCHEMA, SOURCE_COLUMN: 'category'}
+
+
+def sharepoint_sources(sharepoint):
+    """Fontes de [[sharepoint.sources]]; sem a lista, o par site_path/excel_filename
+
+    site_url vem da fonte ou, se ela não tiver, de [sharepoint]; RuntimeError
+    se faltar nos dois.
+    """
+    sources = sharepoint.get("sources") or [
+        {'site_path': sharepoint["site_path"], 'filename': sharepoint["excel_filename"]}]
+
+    resolved = []
+    for source in sources:
+        site_url = source.get('site_url') or sharepoint.get('site_url')
+        if not site_url:
+            raise RuntimeError(f"Fonte '{source.get('label') or source['filename']}' sem site_url: "
+                               "defina site_url na fonte ou em [sharepoint].")
+        resolved.append({
+            'site_url': site_url,
+            'site_path': source['site_path'],
+            'filename': source['filename'],
+            'label': source.get('label'),
+        })
+    return resolved
+
+
+def resolve_source(client, source):
+    """Itens (rótulo, site_id, id) da fonte; RuntimeError se nenhum arquivo casar"""
+    # Ids de site e itens memorizados entre cargas
+    site_id = client.site_id(source['site_url'], source['site_path'])
+    items = client.find_items(site_id, source['filename']) if site_id else None
+    if not items:
+        raise RuntimeError(f"Arquivo '{source['filename']}' não encontrado em {source['site_path']}.")
+
+    resolved = []
+    for item_id, name in items:
+        label = source['label'] or name
+        if source['label'] and len(items) > 1:
+            label = f"{source['label']}: {name}"
+        resolved.append((label, site_id, item_id))
+    return resolved
+
+
+def sync_source_item(client, states, source, site_id, item_id):
+    """Sincronizar um item com o seu próprio estado (e snapshot)"""
+    with states['lock']:
+        state = states['items'].setdefault(item_id, {'lock': threading.Lock()})
+
+    events = sync_workbook(client, f"{client.base_url}/sites/{site_id}/drive/items/{item_id}", state)
+    if events is None:
+        # Item pode ter sido movido ou recriado: buscar de novo na próxima carga
+        client.forget(('items', site_id, source['filename']))
+        raise RuntimeError(f"Arquivo '{source['filename']}' inacessível em {source['site_path']}.")
+    return events
+
+
+def merge_sources(parts, previous=None):
+    """Eventos de todas as fontes, marcados pela origem e em ordem cronológica
+
+    Uma resposta presente em mais de uma fonte (mesmas colunas) fica só na
+    primeira; repetições dentro do mesmo workbook são preservadas. Com uma
+    única fonte a ordem é a do workbook, então linhas acrescentadas a ela
+    continuam sendo um acréscimo ao frame combinado anterior (`previous`).
+    """
+    frames = []
+    seen = np.empty(0, dtype=np.uint64)
+    for label, events in parts:
+        if len(parts) > 1:
+            hashes = pd.util.hash_pandas_object(events[EVENT_COLUMNS], index=False).to_numpy()
+            events = events[~np.isin(hashes, seen)]
+            seen = np.concatenate([seen, hashes])
+        origem = pd.Categorical.from_codes(np.zeros(len(events), dtype=np.int8), categories=[label])
+        frames.append(events.assign(**{SOURCE_COLUMN: origem}))
+
+    merged = concat_typed(frames, MERGED_EVENT_SCHEMA)
+    if len(parts) > 1:
+        merged = merged.sort_values('data_hora', kind='stable', ignore_index=True)
+
+    keys = '|'.join(f"{label}:{events.attrs['source_hash']}" for label, events in parts)
+    merged.attrs = {'source_hash': hashlib.sha1(keys.encode()).hexdigest()}
+
+    if len(parts) == 1 and previous is not None and len(previous[0]) == 1:
+        (label, events), (previous_label, previous_events) = parts[0], previous[0][0]
+        base_key, base_len = events.attrs.get('appended_to', (None, None))
+        if label == previous_label and base_key == previous_events.attrs.get('source_hash'):
+            merged.attrs['appended_to'] = (previous[1].attrs['source_hash'], base_len)
+    return merged
+
+
+def fetch_sharepoint_events(client, states, sources):
+    """Sincronizar todas as fontes em paralelo e devolver os eventos combinados
+
+    Cada workbook tem seu estado de sincronização e seu snapshot, e o pool
+    limita as requisições simultâneas; o tempo total acompanha o arquivo
+    mais lento, não a soma. Se alguma fonte falhar, RuntimeError.
+    """
+    if client.headers() is None:
+        raise RuntimeError("Erro ao acessar o SharePoint. Verifique as credenciais.")
+
+    with ThreadPoolExecutor(max_workers=SOURCE_WORKERS, thread_name_prefix="sharepoint-source",
+                            initializer=set_thread_timings, initargs=(get_timings(),)) as pool:
+        resolving = [pool.submit(resolve_source, client, source) for source in sources]
+        items = [(label, source, site_id, item_id)
+                 for source, future in zip(sources, resolving)
+                 for label, site_id, item_id in future.result()]
+
+        syncing = [pool.submit(sync_source_item, client, states, source, site_id, item_id)
+                   for _, source, site_id, item_id in items]
+        parts = [(label, future.result()) for (label, *_), future in zip(items, syncing)]
+
+    # Nada mudou em nenhuma fonte: devolver o mesmo frame (sem rerun nem nova versão)
+    with states['lock']:
+        previous = states.get('merged')
+        if previous is not None and len(previous[0]) == len(parts) and all(
+                a[0] == b[0] and a[1] is b[1] for a, b in zip(previous[0], parts)):
+            return previous[1]
+
+    with timed('merge', rows=sum(len(events) for _, events in parts)):
+        merged = merge_sources(parts, previous)
+    prune_snapshots({events.attrs['source_hash'] for _, events in parts} | {merged.attrs['source_hash']})
+
+    with states['lock']:
+        states['merged'] = (parts, merged)
+    return merged
+
+
+REFRESH_INTERVAL = 300  # segundos
+
+
+class BackgroundRefresher:
+    """Worker do processo que mantém os eventos atualizados
+
+    Uma thread daemon chama `fetch` a cada `interval` segundos, ou antes
+    quando request_refresh() é chamado, e troca o resultado pronto numa
+    única atribuição. As sessões só leem `result` (eventos, carregado_em)
+    e nunca esperam, exceto pela primeira carga do processo. A thread não
+    chama comandos st; erros ficam em `error` e os dados anteriores seguem
+    valendo.
+    """
+
+    def __init__(self, fetch, interval=REFRESH_INTERVAL, timings=None):
+        self.interval = interval
+        self.result = None
+        self.error = None
+        self.refreshing = False
+        self._fetch = fetch
+        self._timings = timings
+        self._wake = threading.Event()
+        self._ready = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="sharepoint-refresher", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        set_thread_timings(self._timings)
+        while not self._stopped.is_set():
+            self.refreshing = True
+            try:
+                self.result = (self._fetch(), datetime.now())
+                self.error = None
+            except Exception as e:
+                logger.exception("falha ao atualizar os dados do SharePoint")
+                self.error = str(e)
+            finally:
+                self.refreshing = False
+                self._ready.set()
+
+            # Pedidos feitos durante a busca acordam o próximo ciclo na hora
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def request_refresh(self):
+        """Enfileirar uma nova busca sem esperar por ela"""
+        self._wake.set()
+
+    def wait_ready(self, timeout=None):
+        """Esperar a primeira busca terminar (com ou sem sucesso)"""
+        self._ready.wait(timeout)
+        return self.result
+
+    def stop(self):
+        self._stopped.set()
+        self._wake.set()
+
+
+@st.cache_resource(on_release=lambda refresher: refresher.stop())
+def get_refresher():
+    """Worker de atualização do processo, com a configuração lida uma única vez"""
+    client = get_graph_client()
+    states = get_sync_state()
+    sources = sharepoint_sources(st.secrets["sharepoint"])
+
+    return BackgroundRefresher(
+        lambda: fetch_sharepoint_events(client, states, sources),
+        interval=st.secrets.get("cache", {}).get("refresh_interval", REFRESH_INTERVAL),
+        timings=timing_recorder(),
+    )
 
-    except Exception as e:
-        st.error(f"Erro ao carregar dados do SharePoint: {e}")
-        return pd.DataFrame()
+
+def format_age(loaded_at):
+    """Idade dos dados em texto curto ("agora", "5 min", "2 h 10 min")"""
+    minutes = int((datetime.now() - loaded_at).total_seconds() // 60)
+    if minutes < 1:
+        return "agora"
+    if minutes < 60:
+        return f"há {minutes} min"
+    return f"há {minutes // 60} h {minutes % 60:02d} min"
 
 
 def process_trips(df):
     """Processar dados para criar viagens completas"""
-    df['data_hora'] = pd.to_datetime(df['data_hora'], format='%d/%m/%Y %H:%M')
-    df = df.sort_values(['nome', 'placa', 'data_hora'])
-
-    trips = []
-    orphan_arrivals = []  # Chegadas órfãs
-
-    # Agrupar por motorista e veículo
-    for (nome, placa), group in df.groupby(['nome', 'placa']):
-        saida = None
-
-        for _, row in group.iterrows():
-            if row['tipo'] == 'Saída':
-                saida = row
-            elif row['tipo'] == 'Chegada':
-                if saida is not None:
-                    # Criar viagem completa
-                    tempo_viagem = (row['data_hora'] - saida['data_hora']).total_seconds() / 60
-                    km_rodados = row['km'] - saida['km'] if row['km'] > saida['km'] else 0
-
-                    trips.append({
-                        'motorista': nome,
-                        'placa': placa,
-                        'modelo': saida['modelo'],
-                        'data_saida': saida['data_hora'],
-                        'data_chegada': row['data_hora'],
-                        'km_inicial': saida['km'],
-                        'km_final': row['km'],
-                        'km_rodados': km_rodados,
-                        'tempo_viagem': tempo_viagem,
-                        'finalidade': saida['finalidade'],
-                        'status': 'Completa'
-                    })
-                    saida = None
-                else:
-                    # Chegada órfã (sem saída correspondente)
-                    orphan_arrivals.append({
-                        'motorista': nome,
-                        'placa': placa,
-                        'modelo': row['modelo'],
-                        'data_chegada': row['data_hora'],
-                        'km_final': row['km'],
-                        'status': 'Chegada Órfã'
-                    })
-
-        # Viagem em aberto (saída sem chegada)
-        if saida is not None:
-            trips.append({
-                'motorista': nome,
-                'placa': placa,
-                'modelo': saida['modelo'],
-                'data_saida': saida['data_hora'],
-                'data_chegada': None,
-                'km_inicial': saida['km'],
-                'km_final': None,
-                'km_rodados': None,
-                'tempo_viagem': None,
-                'finalidade': saida['finalidade'],
-                'status': 'Em Aberto'
-            })
-
-    trips_df = pd.DataFrame(trips)
-    orphans_df = pd.DataFrame(orphan_arrivals)
+    trips_df, orphans_df, _ = pair_events(df)
+    return trips_df, orphans_df
 
+
+def pairable_events(df):
+    """Eventos que entram no pareamento (Saída/Chegada com nome e placa)"""
+    return df[df['tipo'].isin(['Saída', 'Chegada']) & df['nome'].notna() & df['placa'].notna()]
+
+
+def pair_events(df):
+    """Viagens, chegadas órfãs e estado de pareamento dos eventos
+
+    Cada Saída é pareada com a Chegada seguinte do mesmo (nome, placa). Só a
+    última Saída pendente conta, então uma Chegada fecha viagem exatamente
+    quando o evento anterior do grupo é uma Saída; o pareamento é feito com
+    ordenação, shift e máscaras em vez de percorrer os grupos linha a linha.
+    O estado guarda, por grupo, a data do último evento e a posição (índice
+    de `df`) da Saída pendente, ou -1.
+    """
+    df = pairable_events(df).copy()
+    df['data_hora'] = parse_data_hora(df['data_hora'])
+    df = df.sort_values(['nome', 'placa', 'data_hora'], kind='stable')
+    positions = df.index.to_numpy()
+    df = df.reset_index(drop=True)
+
+    n = len(df)
+    if n == 0:
+        return (apply_schema(pd.DataFrame(columns=TRIP_COLUMNS), TRIP_SCHEMA),
+                apply_schema(pd.DataFrame(columns=ORPHAN_COLUMNS), ORPHAN_SCHEMA),
+                apply_schema(pd.DataFrame(columns=PAIRING_COLUMNS), PAIRING_SCHEMA))
+
+    # Marcar onde começa cada grupo (motorista, veículo)
+    novo_grupo = (df['nome'].ne(df['nome'].shift()) | df['placa'].ne(df['placa'].shift())).to_numpy()
+    ultimo_do_grupo = np.append(novo_grupo[1:], True)
+    is_saida = (df['tipo'] == 'Saída').to_numpy()
+
+    # Chegada com Saída imediatamente antes no mesmo grupo fecha a viagem
+    saida_anterior = np.insert(is_saida[:-1], 0, False)
+    chegada_pareada = ~is_saida & saida_anterior & ~novo_grupo
+    chegada_orfa = ~is_saida & ~chegada_pareada
+
+    # Saída seguida da Chegada pareada vira viagem completa; no fim do grupo, em aberto.
+    # Uma Saída seguida de outra Saída é sobrescrita, como no laço original.
+    saida_fechada = np.append(chegada_pareada[1:], False)
+    saida_aberta = is_saida & ultimo_do_grupo
+
+    pos = np.flatnonzero(saida_fechada | saida_aberta)
+    fechada = saida_fechada[pos]
+    saidas = df.iloc[pos]
+    chegadas = df.iloc[np.minimum(pos + 1, n - 1)]
+
+    km_inicial = saidas['km'].to_numpy(dtype='float64', na_value=np.nan)
+    km_final = np.where(fechada, chegadas['km'].to_numpy(dtype='float64', na_value=np.nan), np.nan)
+    data_chegada = chegadas['data_hora'].to_numpy().copy()
+    data_chegada[~fechada] = np.datetime64('NaT')
+    tempo_viagem = (data_chegada - saidas['data_hora'].to_numpy()) / np.timedelta64(1, 'm')
+    km_rodados = np.where(km_final > km_inicial, km_final - km_inicial, 0.0)
+    km_rodados[~fechada] = np.nan
+
+    # Rótulos seguem como category (.array) em vez de virar object
+    trips_df = apply_schema(pd.DataFrame({
+        'motorista': saidas['nome'].array,
+        'email': saidas['email'].array,
+        'placa': saidas['placa'].array,
+        'modelo': saidas['modelo'].array,
+        'data_saida': saidas['data_hora'].to_numpy(),
+        'data_chegada': data_chegada,
+        'km_inicial': km_inicial,
+        'km_final': km_final,
+        'km_rodados': km_rodados,
+        'tempo_viagem': tempo_viagem,
+        'finalidade': saidas['finalidade'].array,
+        'status': pd.Categorical.from_codes((~fechada).astype(np.int8), categories=TRIP_STATUS),
+    }), TRIP_SCHEMA)
+
+    orfas = df[chegada_orfa]
+    orphans_df = apply_schema(pd.DataFrame({
+        'motorista': orfas['nome'].array,
+        'placa': orfas['placa'].array,
+        'modelo': orfas['modelo'].array,
+        'data_chegada': orfas['data_hora'].to_numpy(),
+        'km_final': orfas['km'].array,
+        'status': pd.Categorical(['Chegada Órfã'] * len(orfas)),
+    }), ORPHAN_SCHEMA)
+
+    ultimos = df[ultimo_do_grupo]
+    pairing_df = apply_schema(pd.DataFrame({
+        'nome': ultimos['nome'].array,
+        'placa': ultimos['placa'].array,
+        'last_seen': ultimos['data_hora'].to_numpy(),
+        'open_pos': np.where(is_saida[ultimo_do_grupo], positions[ultimo_do_grupo], -1),
+    }), PAIRING_SCHEMA)
+
+    return trips_df, orphans_df, pairing_df
+
+
+def group_keys(nomes, placas):
+    """Chaves (nome, placa) como MultiIndex de valores, comparáveis entre frames"""
+    return pd.MultiIndex.from_arrays([np.asarray(nomes, dtype=object), np.asarray(placas, dtype=object)])
+
+
+def in_groups(nomes, placas, keys):
+    """Máscara das linhas cujo (nome, placa) está em keys; filtra por categoria antes de comparar pares"""
+    mask = (nomes.isin(keys.get_level_values(0)) & placas.isin(keys.get_level_values(1))).to_numpy().copy()
+    candidates = np.flatnonzero(mask)
+    mask[candidates] = group_keys(nomes.iloc[candidates], placas.iloc[candidates]).isin(keys)
+    return mask
+
+
+def extend_trips(events, base_len, trips_df, orphans_df, pairing_df):
+    """Parear só os eventos após base_len sobre o resultado da versão anterior
+
+    Para um (nome, placa) cujos eventos novos não são anteriores ao último
+    já visto, basta parear a Saída pendente (se houver) com os novos: a
+    viagem em aberto dela é substituída pelo resultado. Eventos retroativos
+    fazem o grupo inteiro ser pareado de novo; os demais grupos não mudam.
+    """
+    new = pairable_events(events.iloc[base_len:])
+    if new.empty:
+        return trips_df, orphans_df, pairing_df
+
+    state = pairing_df.set_index(group_keys(pairing_df['nome'], pairing_df['placa']))
+    new_keys = group_keys(new['nome'], new['placa'])
+    first_new = pd.Series(new['data_hora'].to_numpy(), index=new_keys).groupby(level=[0, 1]).min()
+    last_seen = state['last_seen'].reindex(first_new.index)
+    known = first_new.index.isin(state.index)
+    backdated = known & (last_seen.isna() | (first_new < last_seen)).to_numpy()
+
+    appended_keys = first_new.index[~backdated]
+    backdated_keys = first_new.index[backdated]
+    open_pos = state['open_pos'].reindex(appended_keys).dropna().astype(np.int64)
+    open_pos = open_pos[open_pos >= 0]
+
+    # Subconjunto reprocessado: novos eventos dos grupos anexados, suas Saídas
+    # pendentes e todos os eventos dos grupos com eventos retroativos
+    subset = [events.iloc[open_pos.to_numpy()], new[~new_keys.isin(backdated_keys)]]
+    if len(backdated_keys):
+        subset.append(events[in_groups(events['nome'], events['placa'], backdated_keys)])
+    new_trips, new_orphans, new_pairing = pair_events(pd.concat(subset))
+
+    # Remover o que será substituído: viagens em aberto dos grupos anexados e
+    # tudo dos grupos retroativos
+    drop_trips = np.flatnonzero((trips_df['status'] == 'Em Aberto').to_numpy())
+    open_keys = group_keys(trips_df['motorista'].iloc[drop_trips], trips_df['placa'].iloc[drop_trips])
+    drop_trips = drop_trips[open_keys.isin(open_pos.index)]
+    if len(backdated_keys):
+        in_backdated = in_groups(trips_df['motorista'], trips_df['placa'], backdated_keys)
+        drop_trips = np.union1d(drop_trips, np.flatnonzero(in_backdated))
+        orphans_df = orphans_df[~in_groups(orphans_df['motorista'], orphans_df['placa'], backdated_keys)]
+
+    # As viagens estão ordenadas por saída: só a cauda a partir da primeira
+    # posição afetada (removida ou com saída nova) é reordenada
+    new_trips = new_trips.sort_values('data_saida', kind='stable')
+    start = len(trips_df)
+    if len(new_trips):
+        start = int(trips_df['data_saida'].searchsorted(new_trips['data_saida'].iloc[0], side='right'))
+    if len(drop_trips):
+        start = min(start, int(drop_trips[0]))
+
+    tail = trips_df.iloc[start:]
+    tail = tail.drop(index=tail.index[drop_trips[drop_trips >= start] - start]) if len(drop_trips) else tail
+    tail = concat_typed([tail, new_trips], TRIP_SCHEMA).sort_values('data_saida', kind='stable')
+    trips_df = concat_typed([trips_df.iloc[:start], tail], TRIP_SCHEMA)
+
+    orphans_df = concat_typed([orphans_df, new_orphans], ORPHAN_SCHEMA)
+    replaced = state.index.isin(group_keys(new_pairing['nome'], new_pairing['placa']))
+    pairing_df = concat_typed([pairing_df[~replaced], new_pairing], PAIRING_SCHEMA)
+    return trips_df, orphans_df, pairing_df
+
+
+@st.cache_resource
+def get_pairing_state():
+    """Último pareamento do processo, ponto de partida do próximo incremental"""
+    return {'lock': threading.Lock(), 'key': None}
+
+
+def build_trips(events):
+    """Viagens (ordenadas por saída) e chegadas órfãs da versão dos eventos
+
+    Se os eventos apenas acrescentam linhas à versão pareada por último
+    (attrs['appended_to']), só as novas são pareadas (extend_trips); senão
+    o snapshot da versão é reaproveitado ou tudo é pareado de novo.
+    """
+    key = events.attrs.get('source_hash')
+    base_key, base_len = events.attrs.get('appended_to', (None, None))
+    state = get_pairing_state()
+
+    with state['lock']:
+        if key and state['key'] == key:
+            return state['trips'], state['orphans']
+
+        frames = None
+        if base_key and state['key'] == base_key and state['n_events'] == base_len:
+            with timed('process_trips', rows=len(events) - base_len, incremental=True) as span:
+                frames = extend_trips(events, base_len, state['trips'], state['orphans'], state['pairing'])
+                span['trips'] = len(frames[0])
+        elif key:
+            snapshot = load_snapshot(key, ['trips', 'orphans', 'pairing'])
+            if snapshot is not None:
+                frames = snapshot[0]['trips'], snapshot[0]['orphans'], snapshot[0]['pairing']
+                key = None  # já está em disco
+
+        if frames is None:
+            with timed('process_trips', rows=len(events)) as span:
+                trips_df, orphans_df, pairing_df = pair_events(events)
+                # Ordenadas por data de saída para o corte por período via searchsorted
+                trips_df = trips_df.sort_values('data_saida', kind='stable', ignore_index=True)
+                frames = trips_df, orphans_df, pairing_df
+                span['trips'] = len(trips_df)
+
+        trips_df, orphans_df, pairing_df = frames
+        if key:
+            save_snapshot(key, {'trips': trips_df, 'orphans': orphans_df, 'pairing': pairing_df})
+        state.update(key=events.attrs.get('source_hash'), n_events=len(events),
+                     trips=trips_df, orphans=orphans_df, pairing=pairing_df)
     return trips_df, orphans_df
 
 
+def date_window(dates, data_inicio, data_fim):
+    """Posições [início, fim) das datas ordenadas dentro do período (busca binária)"""
+    inicio = pd.Timestamp(data_inicio)
+    fim = pd.Timestamp(data_fim) + pd.Timedelta(days=1)
+    return dates.searchsorted(inicio, side='left'), dates.searchsorted(fim, side='left')
+
+
+def filter_trips(trips, data_inicio, data_fim, motoristas, status):
+    """Viagens do período e da seleção; o corte por data vem primeiro
+
+    As viagens estão ordenadas por data_saida, então o período vira um
+    fatiamento e as máscaras de motorista e status só olham essa fatia.
+    `motoristas` None (nenhum escolhido no filtro) vale para todos.
+    """
+    inicio, fim = date_window(trips['data_saida'], data_inicio, data_fim)
+    window = trips.iloc[inicio:fim]
+    return window[motorista_mask(window, motoristas) & window['status'].isin(status)]
+
+
+def motorista_mask(df, motoristas):
+    """Máscara dos motoristas selecionados; None seleciona todos sem isin"""
+    if motoristas is None:
+        return np.ones(len(df), dtype=bool)
+    return df['motorista'].isin(motoristas).to_numpy()
+
+
+def data_version(events):
+    """Identificador da versão dos eventos carregados (hash da origem)"""
+    version = events.attrs.get('source_hash')
+    if version is None:
+        version = format(int(pd.util.hash_pandas_object(events, index=False).sum()), 'x')
+    return version
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_trips(version, _events):
+    """Viagens e chegadas órfãs por versão dos dados, fora do ciclo de rerun"""
+    return build_trips(_events)
+
+
+# Verificações de qualidade dos dados da frota
+ISSUE_TYPES = ['Hodômetro regrediu', 'Viagens sobrepostas', 'Velocidade implausível']
+ISSUE_SCHEMA = {
+    'tipo': 'category', 'placa': 'category', 'motorista': 'category', 'data': 'datetime64', 'detalhe': 'object',
+}
+ISSUE_COLUMNS = list(ISSUE_SCHEMA)
+MAX_SPEED_KMH = 150
+
+
+def issue_frame(tipo, rows, motorista, data, detalhes):
+    """Frame de ocorrências de um tipo, no esquema ISSUE_SCHEMA"""
+    return apply_schema(pd.DataFrame({
+        'tipo': pd.Categorical([tipo] * len(rows), categories=ISSUE_TYPES),
+        'placa': rows['placa'].array,
+        'motorista': motorista.array,
+        'data': data.to_numpy(),
+        'detalhe': pd.array(detalhes, dtype=object),
+    }), ISSUE_SCHEMA)
+
+
+def format_km(value):
+    """KM com separador de milhar brasileiro"""
+    return f"{value:,.0f}".replace(',', '.')
+
+
+def odometer_regressions(events):
+    """Eventos cujo KM é menor que o do evento anterior do mesmo veículo
+
+    Uma ordenação por (placa, data_hora) e a comparação com o vizinho
+    anterior; pega também a Chegada com KM abaixo da Saída, que o
+    pareamento registra como 0 km rodados.
+    """
+    df = events[events['km'].notna()].sort_values(['placa', 'data_hora'], kind='stable')
+    placas = df['placa'].cat.codes.to_numpy()
+    km = df['km'].to_numpy(dtype='int64')
+    regrediu = np.flatnonzero((placas[1:] == placas[:-1]) & (km[1:] < km[:-1])) + 1
+
+    rows, anteriores = df.iloc[regrediu], df.iloc[regrediu - 1]
+    detalhes = [f"{tipo}: KM {format_km(atual)} após {format_km(antes)} ({anterior} em {data:%d/%m/%Y %H:%M})"
+                for tipo, atual, antes, anterior, data in zip(rows['tipo'], rows['km'], anteriores['km'],
+                                                              anteriores['tipo'], anteriores['data_hora'])]
+    return issue_frame('Hodômetro regrediu', rows, rows['nome'], rows['data_hora'], detalhes)
+
+
+def overlapping_trips(trips):
+    """Viagens que saem antes de terminar uma viagem anterior do mesmo veículo
+
+    Varredura por placa ordenada por saída: o máximo acumulado das chegadas
+    anteriores (e a viagem que o atingiu) diz se o intervalo se sobrepõe a
+    algum anterior, sem comparar viagens duas a duas.
+    """
+    df = trips[trips['data_chegada'].notna()].sort_values(['placa', 'data_saida'], kind='stable')
+    n = len(df)
+    placas = df['placa'].cat.codes.to_numpy()
+    saida = df['data_saida'].to_numpy()
+    chegada = df['data_chegada'].to_numpy()
+
+    novo_grupo = np.insert(placas[1:] != placas[:-1], 0, True)
+    maior_chegada = df.groupby(placas, sort=False)['data_chegada'].cummax().to_numpy()
+    # Posição da viagem dona do máximo: as posições crescem e cada grupo recomeça no seu primeiro
+    dona = np.maximum.accumulate(np.where(chegada == maior_chegada, np.arange(n), 0)) if n else np.arange(0)
+
+    anterior = np.flatnonzero(~novo_grupo)
+    sobreposta = anterior[saida[anterior] < maior_chegada[anterior - 1]]
+    outras = df.iloc[dona[sobreposta - 1]]
+
+    rows = df.iloc[sobreposta]
+    detalhes = [f"Veículo ainda na viagem de {motorista} ({saiu:%d/%m %H:%M}–{chegou:%d/%m %H:%M})"
+                for motorista, saiu, chegou in zip(outras['motorista'], outras['data_saida'], outras['data_chegada'])]
+    return issue_frame('Viagens sobrepostas', rows, rows['motorista'], rows['data_saida'], detalhes)
+
+
+def implausible_speeds(trips):
+    """Viagens completas com velocidade média acima de MAX_SPEED_KMH"""
+    km = trips['km_rodados'].to_numpy(dtype='float64', na_value=np.nan)
+    minutos = trips['tempo_viagem'].to_numpy(dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        velocidade = np.where(km > 0, km / (minutos / 60), np.nan)
+    rapida = velocidade > MAX_SPEED_KMH
+
+    rows = trips[rapida]
+    detalhes = [f"{format_km(km_viagem)} km em {minutos_viagem:.0f} min ({format_km(kmh)} km/h)"
+                if minutos_viagem > 0 else f"{format_km(km_viagem)} km sem tempo de viagem"
+                for km_viagem, minutos_viagem, kmh in zip(km[rapida], minutos[rapida], velocidade[rapida])]
+    return issue_frame('Velocidade implausível', rows, rows['motorista'], rows['data_saida'], detalhes)
+
+
+def check_consistency(events, trips):
+    """Ocorrências de qualidade dos dados, ordenadas por data"""
+    with timed('consistencia') as span:
+        issues = concat_typed([odometer_regressions(events), overlapping_trips(trips),
+                               implausible_speeds(trips)], ISSUE_SCHEMA)
+        issues = issues.sort_values('data', kind='stable', ignore_index=True)
+        span['rows'] = len(issues)
+    return issues
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_issues(version, _events, _trips):
+    """Ocorrências de qualidade da versão dos dados"""
+    return check_consistency(_events, _trips)
+
+
+def filter_issues(issues, data_inicio, data_fim, motoristas):
+    """Ocorrências do período e dos motoristas selecionados"""
+    inicio, fim = date_window(issues['data'], data_inicio, data_fim)
+    window = issues.iloc[inicio:fim]
+    return window[motorista_mask(window, motoristas)]
+
+
+# Agregados estreitos que alimentam os gráficos: dia × status × uma dimensão
+ROLLUP_DIMENSIONS = ['motorista', 'finalidade', 'hora']
+
+
+def rollup_trips(trips, dimension):
+    """Viagens e KM por dia × status × `dimension`, ordenados por dia"""
+    keyed = trips.assign(dia=trips['data_saida'].dt.normalize(), hora=trips['data_saida'].dt.hour, viagens=1)
+    return (
+        keyed.groupby(['dia', 'status', dimension], dropna=False, observed=True)[['viagens', 'km_rodados']]
+        .sum()
+        .reset_index()
+    )
+
+
+def build_rollups(trips):
+    """Um agregado por dimensão dos gráficos
+
+    Cruzar todas as dimensões de uma vez dava quase uma linha por viagem;
+    separados, cada agregado só cruza dia × status × dimensão e fica bem
+    menor que as viagens (o de motorista, o maior, tem no máximo uma linha
+    por motorista ativo no dia).
+    """
+    return {dimension: rollup_trips(trips, dimension) for dimension in ROLLUP_DIMENSIONS}
+
+
+def slice_rollups(rollups, data_inicio, data_fim, motoristas, status, filtered_trips):
+    """Fatias dos agregados para o período e seleção dos filtros
+
+    Finalidade e hora não cruzam com motorista: com motoristas escolhidos
+    elas saem das viagens já filtradas (só a seleção no período), uma linha
+    por viagem, que chart_data soma do mesmo jeito.
+    """
+    slices = {}
+    for dimension, rollup in rollups.items():
+        if motoristas is not None and dimension != 'motorista':
+            keyed = filtered_trips.assign(hora=filtered_trips['data_saida'].dt.hour, viagens=1)
+            slices[dimension] = keyed[[dimension, 'viagens', 'km_rodados']]
+            continue
+        inicio, fim = date_window(rollup['dia'], data_inicio, data_fim)
+        window = rollup.iloc[inicio:fim]
+        mask = window['status'].isin(status).to_numpy()
+        if dimension == 'motorista':
+            mask = mask & motorista_mask(window, motoristas)
+        slices[dimension] = window[mask]
+    return slices
+
+
+# Índice de somas acumuladas por (status, motorista, dia) para os KPIs
+KPI_MEASURES = ['viagens', 'km_rodados', 'tempo_total', 'tempo_n']
+
+
+def build_kpi_index(trips):
+    """Somas acumuladas das medidas dos KPIs, ordenadas por (status, motorista, dia)
+
+    Cada célula não vazia vira uma chave grupo * span + dia; como as chaves
+    de um grupo são contíguas, a soma de um grupo num intervalo de dias é a
+    diferença de duas posições da soma acumulada global (duas buscas
+    binárias), sem repassar as viagens.
+    """
+    motoristas = trips['motorista'].cat.categories
+    dias = trips['data_saida'].dt.normalize()
+    origem = dias.min() if len(trips) else pd.Timestamp(0)
+    dia = ((dias - origem) // pd.Timedelta(days=1)).to_numpy(dtype='int64')
+    span = int(dia.max()) + 2 if len(trips) else 1
+    grupo = trips['status'].cat.codes.to_numpy('int64') * len(motoristas) + trips['motorista'].cat.codes.to_numpy()
+
+    celulas = pd.DataFrame({
+        'chave': grupo * span + dia,
+        'viagens': 1,
+        'km_rodados': trips['km_rodados'].fillna(0).to_numpy('float64'),
+        'tempo_total': trips['tempo_viagem'].fillna(0).to_numpy('float64'),
+        'tempo_n': trips['tempo_viagem'].notna().to_numpy('int64'),
+    }).groupby('chave', sort=True).sum()
+
+    acumulado = np.zeros((len(celulas) + 1, len(KPI_MEASURES)))
+    np.cumsum(celulas[KPI_MEASURES].to_numpy('float64'), axis=0, out=acumulado[1:])
+    return {
+        'chaves': celulas.index.to_numpy(),
+        'acumulado': acumulado,
+        'origem': origem,
+        'span': span,
+        'status': trips['status'].cat.categories,
+        'motoristas': motoristas,
+    }
+
+
+def kpi_window(index, data_inicio, data_fim, motoristas, status):
+    """Totais dos KPIs para o período e seleção, direto do índice acumulado
+
+    Uma busca binária por borda do período em cada grupo (status,
+    motorista) selecionado. Motoristas ativos são os grupos com viagens no
+    período, contados por motorista. `motoristas` None vale para todos.
+    Data início depois da data fim é um período vazio, como em filter_trips.
+    """
+    span = index['span']
+    inicio, fim = ((pd.Timestamp(data) - index['origem']) // pd.Timedelta(days=1)
+                   for data in (data_inicio, pd.Timestamp(data_fim) + pd.Timedelta(days=1)))
+    inicio, fim = min(max(inicio, 0), span - 1), min(max(fim, 0), span - 1)
+    fim = max(fim, inicio)
+
+    if motoristas is None:
+        motorista_codes = np.arange(len(index['motoristas']))
+    else:
+        motorista_codes = index['motoristas'].get_indexer(motoristas)
+        motorista_codes = motorista_codes[motorista_codes >= 0]
+    status_codes = index['status'].get_indexer(status)
+    status_codes = status_codes[status_codes >= 0]
+    grupos = (status_codes[:, None] * len(index['motoristas']) + motorista_codes[None, :]).ravel()
+
+    acumulado = index['acumulado']
+    por_grupo = (acumulado[np.searchsorted(index['chaves'], grupos * span + fim)]
+                 - acumulado[np.searchsorted(index['chaves'], grupos * span + inicio)])
+    totais = dict(zip(KPI_MEASURES, por_grupo.sum(axis=0) if len(grupos) else np.zeros(len(KPI_MEASURES))))
+
+    ativos = np.unique(grupos[por_grupo[:, 0] > 0] % len(index['motoristas'])) if len(grupos) else grupos
+    return {
+        'viagens': int(totais['viagens']),
+        'km_rodados': totais['km_rodados'],
+        'tempo_medio': totais['tempo_total'] / totais['tempo_n'] if totais['tempo_n'] else 0.0,
+        'motoristas_ativos': len(ativos),
+    }
+
+
+def previous_window(data_inicio, data_fim):
+    """Período anterior com o mesmo número de dias"""
+    dias = pd.Timestamp(data_fim) - pd.Timestamp(data_inicio) + pd.Timedelta(days=1)
+    return (pd.Timestamp(data_inicio) - dias).date(), (pd.Timestamp(data_inicio) - pd.Timedelta(days=1)).date()
+
+
+def format_delta(atual, anterior, sufixo='', percentual=False):
+    """Texto do delta de um KPI; None (sem delta) quando o período anterior não tem base"""
+    if anterior is None or (percentual and not anterior):
+        return None
+    if percentual:
+        return f"{(atual / anterior - 1) * 100:+.1f}%{sufixo}"
+    return f"{atual - anterior:+,.0f}{sufixo}"
+
+
+# Índice invertido das viagens: busca por prefixo e histórico por motorista/veículo
+SEARCH_FIELDS = {'motorista': 'Motorista', 'placa': 'Placa', 'email': 'E-mail', 'modelo': 'Modelo'}
+SEARCH_LIMIT = 50
+
+
+def search_key(text):
+    """Texto em minúsculas e sem acentos, como é guardado e buscado no índice"""
+    return unicodedata.normalize('NFKD', str(text)).encode('ascii', 'ignore').decode().lower()
+
+
+def build_trip_index(trips):
+    """Índice invertido campo → valor → posições das viagens
+
+    Para cada campo as posições ficam agrupadas pelo código da categoria
+    (offsets + posições, como CSR); dentro de um valor seguem em ordem
+    crescente, isto é, cronológica. Os termos de busca (o valor inteiro e
+    cada palavra dele, sem acentos) ficam num array ordenado, então uma
+    busca por prefixo são duas buscas binárias.
+    """
+    fields = {}
+    terms, owners = [], []
+    for field in SEARCH_FIELDS:
+        codes = trips[field].cat.codes.to_numpy()
+        values = trips[field].cat.categories
+        counts = np.bincount(codes[codes >= 0], minlength=len(values))
+        # Ausentes (código -1) ficam no começo da ordenação e são descartados
+        positions = np.argsort(codes, kind='stable')[len(codes) - counts.sum():]
+        fields[field] = {
+            'values': values,
+            'offsets': np.concatenate([[0], np.cumsum(counts)]),
+            'positions': positions,
+        }
+        for code in np.flatnonzero(counts):
+            key = search_key(values[code])
+            for term in {key, *re.split(r'[\s.@_-]+', key)} - {''}:
+                terms.append(term)
+                owners.append((field, code))
+
+    order = sorted(range(len(terms)), key=terms.__getitem__)
+    return {
+        'fields': fields,
+        'terms': np.array([terms[i] for i in order], dtype=str),
+        'owners': [owners[i] for i in order],
+    }
+
+
+def search_trip_index(index, query, limit=SEARCH_LIMIT):
+    """Valores cujo nome (ou uma palavra dele) começa com `query`, mais viagens primeiro"""
+    prefix = search_key(query).strip()
+    if not prefix:
+        return pd.DataFrame(columns=['campo', 'valor', 'viagens'])
+    inicio = np.searchsorted(index['terms'], prefix, side='left')
+    fim = np.searchsorted(index['terms'], prefix + '\uffff', side='left')
+
+    rows = []
+    for field, code in dict.fromkeys(index['owners'][inicio:fim]):
+        offsets = index['fields'][field]['offsets']
+        rows.append({'campo': field, 'valor': index['fields'][field]['values'][code],
+                     'viagens': int(offsets[code + 1] - offsets[code])})
+    matches = pd.DataFrame(rows, columns=['campo', 'valor', 'viagens'])
+    return matches.sort_values(['viagens', 'valor'], ascending=[False, True], kind='stable').head(limit)
+
+
+def trip_positions(index, field, value):
+    """Posições (cronológicas) das viagens de um valor do campo, sem varrer as viagens"""
+    entry = index['fields'][field]
+    code = entry['values'].get_indexer([value])[0]
+    if code < 0:
+        return entry['positions'][:0]
+    return entry['positions'][entry['offsets'][code]:entry['offsets'][code + 1]]
+
+
+# Gráficos: agregação no servidor para limitar o tamanho do figure JSON
+CHART_TOP_N = 15
+CHART_TOP_N_PIE = 8
+CHART_COLOR = '#F7931E'
+
+
+def time_bucket(data_inicio, data_fim):
+    """Granularidade do gráfico temporal (frequência, rótulo) conforme o período"""
+    days = (pd.Timestamp(data_fim) - pd.Timestamp(data_inicio)).days + 1
+    if days <= 92:
+        return 'D', 'Dia'
+    if days <= 731:
+        return 'W', 'Semana'
+    return 'M', 'Mês'
+
+
+def top_n(series, n, other='Outros'):
+    """Os n maiores valores, com o restante somado em `other`"""
+    series = series.sort_values(ascending=False, kind='stable')
+    if len(series) <= n + 1:
+        return series
+    rest = pd.Series([series.iloc[n:].sum()], index=[other])
+    return pd.concat([series.iloc[:n].rename(index=str), rest])
+
+
+def chart_data(slices, bucket='D'):
+    """Séries dos quatro gráficos a partir das fatias dos agregados
+
+    O gráfico temporal é agregado por dia, semana ou mês (`bucket`) e os de
+    motorista e finalidade mostram só os maiores, mais "Outros".
+    """
+    por_motorista = slices['motorista']
+    periodo = (por_motorista['dia'] if bucket == 'D'
+               else por_motorista['dia'].dt.to_period(bucket).dt.start_time)
+    viagens_por_periodo = por_motorista.groupby(periodo)['viagens'].sum().reset_index()
+    viagens_por_periodo.columns = ['Data', 'Viagens']
+
+    viagens_motorista = top_n(por_motorista.groupby('motorista', observed=True)['viagens'].sum(), CHART_TOP_N)
+    viagens_motorista = viagens_motorista.rename_axis('Motorista').reset_index(name='Viagens')
+
+    km_finalidade = top_n(slices['finalidade'].groupby('finalidade', observed=True)['km_rodados'].sum(),
+                          CHART_TOP_N_PIE)
+    km_finalidade = km_finalidade.rename_axis('finalidade').reset_index(name='km_rodados')
+
+    movimentos_hora = slices['hora'].groupby('hora')['viagens'].sum().sort_index().reset_index()
+    movimentos_hora.columns = ['Hora', 'Viagens']
+
+    return {
+        'viagens_por_periodo': viagens_por_periodo,
+        'viagens_motorista': viagens_motorista,
+        'km_finalidade': km_finalidade,
+        'movimentos_hora': movimentos_hora,
+    }
+
+
+def style_figure(fig):
+    fig.update_layout(
+        plot_bgcolor='white',
+        paper_bgcolor='white',
+        font=dict(color='#000000')
+    )
+    return fig
+
+
+def build_figures(charts, periodo_label):
+    """Figuras plotly dos quatro gráficos"""
+    import plotly.express as px
+
+    return {
+        'viagens_por_periodo': style_figure(px.line(
+            charts['viagens_por_periodo'],
+            x='Data',
+            y='Viagens',
+            title=f'Viagens por {periodo_label}',
+            color_discrete_sequence=[CHART_COLOR]
+        )),
+        'viagens_motorista': style_figure(px.bar(
+            charts['viagens_motorista'],
+            x='Viagens',
+            y='Motorista',
+            orientation='h',
+            title='Viagens por Motorista',
+            color_discrete_sequence=[CHART_COLOR]
+        )),
+        'km_finalidade': style_figure(px.pie(
+            charts['km_finalidade'],
+            values='km_rodados',
+            names='finalidade',
+            title='KM por Finalidade',
+            color_discrete_sequence=px.colors.sequential.Oranges_r
+        )),
+        'movimentos_hora': style_figure(px.bar(
+            charts['movimentos_hora'],
+            x='Hora',
+            y='Viagens',
+            title='Movimentação por Hora',
+            color_discrete_sequence=[CHART_COLOR]
+        )),
+    }
+
+
+# cache_resource: as figuras são só lidas pelo st.plotly_chart, então são
+# compartilhadas sem o pickle do cache_data (que custaria quase o mesmo que montá-las)
+@st.cache_resource(max_entries=32, show_spinner=False)
+def load_figures(version, data_inicio, data_fim, motoristas, status, _slices):
+    """Figuras por versão dos dados e estado dos filtros"""
+    bucket, periodo_label = time_bucket(data_inicio, data_fim)
+    with timed('graficos', rows=sum(map(len, _slices.values()))):
+        return build_figures(chart_data(_slices, bucket), periodo_label)
+
+
+# Utilização da frota: varredura sobre os intervalos das viagens
+WEBGL_MIN_POINTS = 1000  # a curva horária passa disso em períodos de ~6 semanas
+
+
+def merge_intervals(groups, starts, ends):
+    """União dos intervalos [início, fim) de cada grupo
+
+    Ordena por (grupo, início) e abre um bloco novo sempre que o início
+    passa do maior fim acumulado do grupo; devolve (grupo, início, fim)
+    dos blocos.
+    """
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+    if len(groups) == 0:
+        return groups, starts, ends
+
+    maior_fim = pd.Series(ends).groupby(groups).cummax().to_numpy()
+    novo_grupo = np.insert(groups[1:] != groups[:-1], 0, True)
+    novo_bloco = novo_grupo | np.insert(starts[1:] > maior_fim[:-1], 0, True)
+    inicio_bloco = np.flatnonzero(novo_bloco)
+    return groups[inicio_bloco], starts[inicio_bloco], np.maximum.reduceat(ends, inicio_bloco)
+
+
+def concurrency_curve(starts, ends, window_start, window_end, freq='h'):
+    """Máximo de intervalos simultâneos em cada período `freq` da janela
+
+    Uma única ordenação dos inícios (+1) e fins (-1), com fins antes de
+    inícios no mesmo instante; as fronteiras dos períodos entram como
+    pontos neutros para que nenhum trecho constante atravesse dois períodos.
+    """
+    fronteiras = pd.date_range(window_start, window_end, freq=freq, inclusive='left').to_numpy()
+    momentos = np.concatenate([starts, ends, fronteiras])
+    passos = np.concatenate([np.ones(len(starts), np.int64), -np.ones(len(ends), np.int64),
+                             np.zeros(len(fronteiras), np.int64)])
+
+    order = np.lexsort((passos, momentos))
+    momentos, nivel = momentos[order], np.cumsum(passos[order])
+    ultimo = np.append(momentos[1:] != momentos[:-1], True)  # nível depois de todos os passos do instante
+    momentos, nivel = momentos[ultimo], nivel[ultimo]
+
+    dentro = momentos < np.datetime64(window_end)
+    curve = pd.Series(nivel[dentro], index=pd.DatetimeIndex(momentos[dentro]))
+    return curve.groupby(curve.index.floor(freq)).max().rename_axis('Momento').reset_index(name='Veículos')
+
+
+def next_departures(trips):
+    """Saída seguinte do mesmo veículo para cada viagem (NaT na última da placa)"""
+    placas = trips['placa'].cat.codes.to_numpy()
+    starts = trips['data_saida'].to_numpy()
+    order = np.lexsort((starts, placas))
+    seguinte = np.append(starts[order][1:], np.datetime64('NaT'))
+    seguinte[np.append(placas[order][1:] != placas[order][:-1], True)] = np.datetime64('NaT')
+    proxima_saida = np.empty_like(starts)
+    proxima_saida[order] = seguinte
+    return proxima_saida
+
+
+def trip_ends(trips, now, proxima_saida=None):
+    """Fim de cada viagem para a utilização
+
+    Viagens em aberto contam até `now`, ou até a saída seguinte do mesmo
+    veículo (que prova que ele voltou), para que uma chegada esquecida não
+    deixe a placa ocupada até hoje.
+    """
+    if proxima_saida is None:
+        proxima_saida = next_departures(trips)
+    ends = trips['data_chegada'].to_numpy().copy()
+    aberta = np.isnat(ends)
+    ends[aberta] = np.fmin(proxima_saida[aberta], pd.Timestamp(now).to_datetime64())  # fmin ignora NaT
+    return ends
+
+
+def utilization_trips(trips, proxima_saida, window_start, window_end, now, motoristas, status):
+    """Viagens da seleção cujo intervalo cruza a janela, com os respectivos fins
+
+    Não basta o corte por data_saida: uma viagem que saiu antes do início e
+    ainda estava fora (ou segue em aberto) ocupa o veículo dentro da janela.
+    As viagens estão ordenadas por saída, então as que saíram antes do fim
+    da janela são um prefixo; `proxima_saida` vem de next_departures() sobre
+    o frame inteiro.
+    """
+    fim = trips['data_saida'].searchsorted(pd.Timestamp(window_end), side='left')
+    prefix = trips.iloc[:fim]
+    ends = trip_ends(prefix, now, proxima_saida[:fim])
+    mask = ((ends > pd.Timestamp(window_start).to_datetime64()) & motorista_mask(prefix, motoristas)
+            & prefix['status'].isin(status).to_numpy())
+    return prefix[mask], ends[mask]
+
+
+def fleet_utilization(trips, window_start, window_end, now, ends=None):
+    """Curva de veículos em uso, pico por dia e horas ocupadas por placa
+
+    `ends` são os fins das viagens (trip_ends); sem eles, são calculados só
+    com as viagens recebidas. Os intervalos de um mesmo veículo são unidos
+    antes da varredura, então viagens sobrepostas contam uma vez.
+    """
+    window_end = min(pd.Timestamp(window_end), pd.Timestamp(now))
+    window_start = pd.Timestamp(window_start)
+    placas = trips['placa'].cat.codes.to_numpy()
+    starts = trips['data_saida'].to_numpy()
+    ends = trip_ends(trips, now) if ends is None else ends
+
+    starts = np.maximum(starts, window_start.to_datetime64())
+    ends = np.minimum(ends, window_end.to_datetime64())
+    valido = ends > starts
+    grupos, starts, ends = merge_intervals(placas[valido], starts[valido], ends[valido])
+
+    curva = concurrency_curve(starts, ends, window_start, window_end) if window_end > window_start else \
+        pd.DataFrame({'Momento': pd.DatetimeIndex([]), 'Veículos': np.array([], np.int64)})
+    pico_dia = (curva.groupby(curva['Momento'].dt.normalize())['Veículos'].max()
+                .rename_axis('Dia').reset_index(name='Pico'))
+
+    categorias = trips['placa'].cat.categories
+    horas = np.bincount(grupos, weights=(ends - starts) / np.timedelta64(1, 'h'), minlength=len(categorias))
+    horas_janela = max((window_end - window_start) / pd.Timedelta(hours=1), 1e-9)
+    por_placa = pd.DataFrame({
+        'placa': categorias,
+        'viagens': np.bincount(placas[placas >= 0], minlength=len(categorias)),
+        'horas_em_uso': horas.round(1),
+        'utilizacao': (horas / horas_janela * 100).round(1),
+    }).sort_values('utilizacao', ascending=False, kind='stable', ignore_index=True)
+
+    return {
+        'curva': curva,
+        'pico_dia': pico_dia,
+        'por_placa': por_placa,
+        'pico': int(curva['Veículos'].max()) if len(curva) else 0,
+        'em_uso_agora': int(np.count_nonzero(ends >= window_end.to_datetime64())) if window_end == now else None,
+    }
+
+
+def build_utilization_figures(utilization):
+    """Figuras da curva de veículos em uso e do pico diário"""
+    import plotly.express as px
+
+    curva = utilization['curva']
+    return {
+        'veiculos_em_uso': style_figure(px.line(
+            curva,
+            x='Momento',
+            y='Veículos',
+            title='Veículos em Uso (máximo por hora)',
+            line_shape='hv',
+            color_discrete_sequence=[CHART_COLOR],
+            render_mode='webgl' if len(curva) > WEBGL_MIN_POINTS else 'auto',
+        )),
+        'pico_dia': style_figure(px.bar(
+            utilization['pico_dia'],
+            x='Dia',
+            y='Pico',
+            title='Pico de Veículos Simultâneos por Dia',
+            color_discrete_sequence=[CHART_COLOR]
+        )),
+    }
+
+
+@st.cache_resource(max_entries=32, show_spinner=False)
+def load_utilization(version, data_inicio, data_fim, motoristas, status, now, _trips):
+    """Utilização e figuras por versão dos dados, filtros e minuto atual"""
+    window_start, window_end = pd.Timestamp(data_inicio), pd.Timestamp(data_fim) + pd.Timedelta(days=1)
+    with timed('utilizacao') as span:
+        trips, ends = utilization_trips(_trips, load_next_departures(version, _trips), window_start, window_end,
+                                        now, motoristas, status)
+        span['rows'] = len(trips)
+        utilization = fleet_utilization(trips, window_start, window_end, now, ends)
+        return utilization, build_utilization_figures(utilization)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_next_departures(version, _trips):
+    """Saída seguinte do mesmo veículo, por viagem, da versão dos dados"""
+    return next_departures(_trips)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_rollups(version, _trips):
+    """Agregados dos gráficos da versão dos dados"""
+    return build_rollups(_trips)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_kpi_index(version, _trips):
+    """Índice acumulado dos KPIs da versão dos dados"""
+    return build_kpi_index(_trips)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def load_trip_index(version, _trips):
+    """Índice invertido de busca da versão dos dados"""
+    with timed('indice_busca', rows=len(_trips)):
+        return build_trip_index(_trips)
+
+
+@st.cache_data(max_entries=4, show_spinner=False)
+def list_motoristas(version, _trips):
+    """Motoristas presentes nas viagens da versão"""
+    return _trips['motorista'].unique().tolist()
+
+
+def memory_report(frames):
+    """Linhas e memória ocupada (deep) por frame, para o painel de depuração"""
+    return pd.DataFrame([
+        {'Frame': name, 'Linhas': len(df), 'Memória (MB)': round(df.memory_usage(deep=True).sum() / 2 ** 20, 2)}
+        for name, df in frames.items()
+    ])
+
+
+PAGE_SIZES = [25, 50, 100, 250]
+
+
+def format_page(page):
+    """Formatar para exibição apenas as linhas da página"""
+    page = page.copy()
+    for column in page.columns:
+        if pd.api.types.is_datetime64_any_dtype(page[column]):
+            page[column] = page[column].dt.strftime(DATA_HORA_FORMAT)
+        elif page[column].dtype == 'float32':
+            page[column] = page[column].round(0).astype('Int64')
+    return page
+
+
+def column_labels(column_config):
+    """Rótulo de exibição de cada coluna de um column_config"""
+    return {column: config if isinstance(config, str) else config['label']
+            for column, config in column_config.items()}
+
+
+def render_paginated_table(df, column_config, key, default_sort):
+    """Tabela paginada e ordenável sobre o frame tipado
+
+    A ordenação usa as colunas originais (datas e números, não texto) e só
+    a página visível é formatada e enviada ao navegador.
+    """
+    columns = list(column_config)
+    labels = column_labels(column_config)
+
+    col_sort, col_order, col_size, col_page = st.columns([3, 2, 2, 2])
+    sort_column = col_sort.selectbox("Ordenar por", columns, index=columns.index(default_sort),
+                                     format_func=labels.get, key=f"{key}_sort")
+    descending = col_order.selectbox("Ordem", ["Crescente", "Decrescente"], key=f"{key}_order") == "Decrescente"
+    page_size = col_size.selectbox("Linhas por página", PAGE_SIZES, key=f"{key}_page_size")
+
+    total = len(df)
+    n_pages = max(1, -(-total // page_size))
+    if st.session_state.get(f"{key}_page", 1) > n_pages:
+        st.session_state[f"{key}_page"] = n_pages
+    page_number = col_page.number_input("Página", min_value=1, max_value=n_pages, step=1, key=f"{key}_page")
+
+    # Posições na ordem escolhida; ordenação estável preserva a ordem de chegada nos empates
+    order = (df[sort_column].reset_index(drop=True)
+             .sort_values(ascending=not descending, kind='stable', na_position='last')
+             .index.to_numpy())
+    start = (page_number - 1) * page_size
+    page = df.iloc[order[start:start + page_size]][columns]
+
+    st.dataframe(format_page(page), width='stretch', column_config=column_config)
+    st.caption(f"Mostrando {min(start + 1, total)}–{min(start + page_size, total)} de {total} registros "
+               f"(página {page_number} de {n_pages})")
+
+
+# Exportação em lotes: cada lote é convertido e gravado antes do próximo
+EXPORT_CHUNK_ROWS = 50000
+EXPORT_DATE_FORMAT = 'dd/mm/yyyy hh:mm'
+EXPORT_FORMATS = {
+    'xlsx': ('📥 Excel', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'csv': ('📥 CSV', 'text/csv'),
+    'parquet': ('📥 Parquet', 'application/vnd.apache.parquet'),
+}
+
+
+def export_chunks(df, columns, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Fatias de até chunk_rows linhas com as colunas exportadas"""
+    for start in range(0, len(df), chunk_rows):
+        yield df.iloc[start:start + chunk_rows][columns]
+
+
+EXCEL_EPOCH = pd.Timestamp('1899-12-30')
+
+
+def chunk_records(chunk):
+    """Linhas do lote como tuplas de valores Python, com ausentes como None
+
+    Datas viram o número serial do Excel e durações são arredondadas, tudo
+    coluna a coluna, para o laço por célula só repassar valores prontos.
+    """
+    columns = []
+    for _, values in chunk.items():
+        if pd.api.types.is_datetime64_any_dtype(values):
+            values = (values - EXCEL_EPOCH) / pd.Timedelta(days=1)
+        elif pd.api.types.is_float_dtype(values):
+            values = values.round(0)
+        columns.append(values.astype(object).where(values.notna(), None).tolist())
+    return zip(*columns)
+
+
+def write_xlsx(df, labels, target):
+    """Gravar em xlsx com xlsxwriter em constant_memory (uma linha por vez no disco)
+
+    Cada coluna usa o write_* do seu tipo, sem a detecção de tipo (e de
+    URLs e fórmulas nos textos) que o write() genérico faz a cada célula.
+    """
+    import xlsxwriter
+
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Dados')
+    worksheet.write_row(0, 0, list(labels.values()))
+
+    date_format = workbook.add_format({'num_format': EXPORT_DATE_FORMAT})
+    writers = []
+    for column in labels:
+        if pd.api.types.is_datetime64_any_dtype(df[column]):
+            writers.append(lambda row, col, value: worksheet.write_number(row, col, value, date_format))
+        elif pd.api.types.is_numeric_dtype(df[column]):
+            writers.append(worksheet.write_number)
+        else:
+            writers.append(worksheet.write_string)
+
+    row_number = 1
+    for chunk in export_chunks(df, list(labels)):
+        for record in chunk_records(chunk):
+            for col, (write, value) in enumerate(zip(writers, record)):
+                if value is not None:
+                    write(row_number, col, value)
+            row_number += 1
+
+    workbook.close()
+
+
+def write_csv(df, labels, target):
+    """Gravar em CSV (separador ';', compatível com o Excel em português) lote a lote"""
+    target.write(codecs.BOM_UTF8)
+    text = io.TextIOWrapper(target, encoding='utf-8', newline='')
+    for i, chunk in enumerate(export_chunks(df, list(labels))):
+        durations = chunk.select_dtypes('float').columns
+        chunk[durations] = chunk[durations].round(0).astype('Int64')
+        chunk.to_csv(text, sep=';', index=False, header=list(labels.values()) if i == 0 else False,
+                     date_format=DATA_HORA_FORMAT)
+    text.flush()
+    text.detach()
+
+
+def write_parquet(df, labels, target):
+    """Gravar em Parquet com os nomes e tipos originais, um row group por lote"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.Schema.from_pandas(df[list(labels)].iloc[:0], preserve_index=False)
+    with pq.ParquetWriter(target, schema) as writer:
+        for chunk in export_chunks(df, list(labels)):
+            writer.write_table(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False))
+
+
+EXPORT_WRITERS = {'xlsx': write_xlsx, 'csv': write_csv, 'parquet': write_parquet}
+
+
+def export_file(df, labels, file_format, timings=None):
+    """Bytes do frame exportado no formato
+
+    Os lotes são gravados num arquivo temporário (vai para o disco acima de
+    SPOOL_MAX_SIZE) e só o resultado final é lido em bytes, o tipo que o
+    download_button aceita de um callable.
+    """
+    timings = timings or get_timings()
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+        with timings.span('exportacao', format=file_format, rows=len(df)) as span:
+            EXPORT_WRITERS[file_format](df, labels, spool)
+            span['bytes'] = spool.tell()
+        spool.seek(0)
+        return spool.read()
+
+
+def render_export_buttons(df, column_config, key, file_stem):
+    """Botões de download do frame em xlsx, CSV e Parquet
+
+    Os arquivos só são gerados no clique, em outra thread, a partir do
+    frame tipado: a página não espera e não há cópia formatada inteira.
+    """
+    labels = column_labels(column_config)
+    timings = get_timings()  # o callable roda fora da thread do script
+    stamp = datetime.now().strftime('%Y%m%d_%H%M')
+
+    for column, (file_format, (label, mime)) in zip(st.columns(len(EXPORT_FORMATS) + 3), EXPORT_FORMATS.items()):
+        column.download_button(
+            label,
+            data=lambda file_format=file_format: export_file(df, labels, file_format, timings),
+            file_name=f"{file_stem}_{stamp}.{file_format}",
+            mime=mime,
+            key=f"{key}_export_{file_format}",
+            on_click='ignore',
+            width='stretch',
+        )
+
+
+DATA_AGE_POLL = 30  # segundos
+
+
+@st.fragment(run_every=DATA_AGE_POLL)
+def data_age_status(refresher, shown_events):
+    """Idade dos dados; reroda o app quando o worker troca os eventos exibidos"""
+    result = refresher.result
+    if result is not None and result[0] is not shown_events:
+        st.rerun(scope="app")
+
+    if result is not None:
+        st.caption(f"🕒 Verificado {format_age(result[1])} ({result[1]:%d/%m %H:%M})")
+    if refresher.refreshing:
+        st.caption("🔄 Atualizando em segundo plano...")
+
+
+def setup_page():
+    """Configuração da página e CSS, antes de qualquer outro elemento"""
+    st.set_page_config(
+        page_title=st.secrets.get("app", {}).get("page_title", "Controle de Veículos"),
+        page_icon="🚗",
+        layout="wide",
+        initial_sidebar_state="expanded"
+    )
+    st.markdown(PAGE_CSS, unsafe_allow_html=True)
+
+
 def main():
+    setup_page()
+
     # Header com logo
     st.markdown("""
     <div class="header-container">
@@ -319,34 +2092,16 @@ def main():
     # Sidebar para filtros
     st.sidebar.markdown("### 🔧 Filtros e Configurações")
 
-    # Botão para atualizar dados
-    if st.sidebar.button("🔄 Atualizar Dados", type="primary", use_container_width=True):
-        st.cache_data.clear()
-        st.rerun()
+    # Botão para atualizar dados: só enfileira uma busca no worker (tratado abaixo)
+    refresh_requested = st.sidebar.button("🔄 Atualizar Dados", type="primary", width='stretch')
 
+    data_age_area = st.sidebar.container()
     st.sidebar.markdown("---")
 
-    # Carregar dados do SharePoint
-    with st.spinner("🔄 Carregando dados do SharePoint..."):
-        raw_data = load_sharepoint_data()
-
-    if raw_data.empty:
-        st.error("❌ Não foi possível carregar os dados do SharePoint. Verifique a conexão.")
-        return
-
-    st.success(f"✅ Dados carregados com sucesso! {len(raw_data)} registros encontrados.")
-
-    trips_data, orphan_arrivals = process_trips(raw_data)
-
-    # Filtros
+    # Filtros que não dependem dos dados: a barra lateral aparece antes da primeira carga
     data_inicio = st.sidebar.date_input("Data Início", value=datetime.now() - timedelta(days=7))
     data_fim = st.sidebar.date_input("Data Fim", value=datetime.now())
-
-    motoristas_selecionados = st.sidebar.multiselect(
-        "Motoristas",
-        options=trips_data['motorista'].unique(),
-        default=trips_data['motorista'].unique()
-    )
+    motoristas_area = st.sidebar.empty()  # opções vêm dos dados
 
     status_selecionado = st.sidebar.multiselect(
         "Status das Viagens",
@@ -354,63 +2109,133 @@ def main():
         default=['Completa', 'Em Aberto']
     )
 
+    # Painéis de depuração: footprint dos frames em memória e tempos por etapa,
+    # preenchidos depois da carga e no fim do rerun
+    memory_panel = st.sidebar.container() if st.sidebar.checkbox("🧠 Uso de memória", value=False) else None
+    timing_panel = st.sidebar.container() if st.sidebar.checkbox("⏱️ Tempos por etapa", value=False) else None
+
+    # Worker e cliente Graph só depois dos filtros; configuração inválida (secrets
+    # ausentes, fontes sem site) vira erro na página em vez de traceback
+    try:
+        refresher = get_refresher()
+    except Exception as e:
+        logger.exception("falha ao iniciar a atualização dos dados do SharePoint")
+        st.error(f"Erro ao carregar dados do SharePoint: {e}")
+        return
+
+    if refresh_requested:
+        refresher.request_refresh()
+        st.toast("Atualização solicitada; os dados serão trocados assim que chegarem.")
+
+    # Carregar dados do SharePoint (só a primeira carga do processo espera)
+    result = refresher.result
+    if result is None:
+        with st.spinner("🔄 Carregando dados do SharePoint..."):
+            result = refresher.wait_ready()
+
+    with data_age_area:
+        data_age_status(refresher, result[0] if result else None)
+
+    if result is None or result[0].empty:
+        st.error(f"❌ Não foi possível carregar os dados do SharePoint. {refresher.error or 'Verifique a conexão.'}")
+        return
+
+    raw_data, _ = result
+    st.success(f"✅ Dados carregados com sucesso! {len(raw_data)} registros encontrados.")
+    if refresher.error:
+        st.warning(f"⚠️ A última atualização falhou ({refresher.error}); exibindo os dados anteriores.")
+
+    version = data_version(raw_data)
+    trips_data, orphan_arrivals = load_trips(version, raw_data)
+    motoristas = list_motoristas(version, trips_data)
+    rollups = load_rollups(version, trips_data)
+    kpi_index = load_kpi_index(version, trips_data)
+    issues = load_issues(version, raw_data, trips_data)
+    trip_index = load_trip_index(version, trips_data)
+
+    # Nenhum motorista escolhido vale para todos: com centenas de motoristas o
+    # widget não carrega todos como padrão e os filtros pulam o isin
+    motoristas_selecionados = motoristas_area.multiselect(
+        "Motoristas",
+        options=motoristas,
+        default=[],
+        placeholder="Todos os motoristas"
+    ) or None
+
+    if memory_panel is not None:
+        memory_panel.dataframe(
+            memory_report({
+                'Eventos': raw_data,
+                'Viagens': trips_data,
+                'Chegadas órfãs': orphan_arrivals,
+                **{f'Agregado por {dimension}': rollup for dimension, rollup in rollups.items()},
+                'Ocorrências': issues,
+            }),
+            hide_index=True,
+            width='stretch'
+        )
+
     # Filtrar dados
-    filtered_trips = trips_data[
-        (trips_data['motorista'].isin(motoristas_selecionados)) &
-        (trips_data['status'].isin(status_selecionado))
-        ]
+    with timed('filtro') as span:
+        filtered_trips = filter_trips(trips_data, data_inicio, data_fim, motoristas_selecionados,
+                                      status_selecionado)
 
-    if not filtered_trips.empty:
-        filtered_trips = filtered_trips[
-            (filtered_trips['data_saida'].dt.date >= data_inicio) &
-            (filtered_trips['data_saida'].dt.date <= data_fim)
-            ]
+        # Gráficos saem dos agregados por dimensão
+        slices = slice_rollups(rollups, data_inicio, data_fim, motoristas_selecionados, status_selecionado,
+                               filtered_trips)
+        filtered_issues = filter_issues(issues, data_inicio, data_fim, motoristas_selecionados)
+        span['rows'] = len(filtered_trips)
 
     # KPIs Principais
     st.markdown('<div class="section-header">📊 Indicadores Principais</div>', unsafe_allow_html=True)
 
+    # Período atual e anterior (mesmo número de dias) saem do índice acumulado
+    atual = kpi_window(kpi_index, data_inicio, data_fim, motoristas_selecionados, status_selecionado)
+    anterior = kpi_window(kpi_index, *previous_window(data_inicio, data_fim), motoristas_selecionados,
+                          status_selecionado)
+    if not anterior['viagens']:
+        anterior = dict.fromkeys(anterior)  # sem viagens no período anterior: KPIs sem delta
+
     col1, col2, col3, col4, col5 = st.columns(5)
 
     with col1:
-        total_viagens = len(filtered_trips)
         st.metric(
             label="Total de Viagens",
-            value=total_viagens,
-            delta=f"+{int(total_viagens * 0.15)} vs mês anterior"
+            value=atual['viagens'],
+            delta=format_delta(atual['viagens'], anterior['viagens'], " vs período anterior")
         )
 
     with col2:
-        viagens_abertas = len(filtered_trips[filtered_trips['status'] == 'Em Aberto'])
+        por_motorista = slices['motorista']
+        viagens_abertas = int(por_motorista.loc[por_motorista['status'] == 'Em Aberto', 'viagens'].sum())
         chegadas_orfas = len(orphan_arrivals) if not orphan_arrivals.empty else 0
-        total_inconsistencias = viagens_abertas + chegadas_orfas
+        total_inconsistencias = viagens_abertas + chegadas_orfas + len(filtered_issues)
         st.metric(
             label="Inconsistências",
             value=total_inconsistencias,
-            delta=f"Abertas: {viagens_abertas}, Órfãs: {chegadas_orfas}"
+            delta=f"Abertas: {viagens_abertas}, Órfãs: {chegadas_orfas}, Dados: {len(filtered_issues)}"
         )
 
     with col3:
-        km_total = filtered_trips['km_rodados'].sum() if not filtered_trips.empty else 0
         st.metric(
             label="KM Rodados",
-            value=f"{km_total:,.0f}",
-            delta="+12.5%"
+            value=f"{atual['km_rodados']:,.0f}",
+            delta=format_delta(atual['km_rodados'], anterior['km_rodados'], percentual=True)
         )
 
     with col4:
-        tempo_medio = filtered_trips['tempo_viagem'].mean() if not filtered_trips.empty else 0
         st.metric(
             label="Tempo Médio (min)",
-            value=f"{tempo_medio:.0f}",
-            delta="-15 min"
+            value=f"{atual['tempo_medio']:.0f}",
+            delta=format_delta(atual['tempo_medio'], anterior['tempo_medio'], " min"),
+            delta_color="inverse"
         )
 
     with col5:
-        motoristas_ativos = filtered_trips['motorista'].nunique() if not filtered_trips.empty else 0
         st.metric(
             label="Motoristas Ativos",
-            value=motoristas_ativos,
-            delta="+1"
+            value=atual['motoristas_ativos'],
+            delta=format_delta(atual['motoristas_ativos'], anterior['motoristas_ativos'])
         )
 
     # Alertas detalhados
@@ -433,147 +2258,194 @@ def main():
                 </div>
                 """, unsafe_allow_html=True)
 
-    # Gráficos
+    # Alertas de qualidade dos dados, um cartão por tipo de ocorrência
+    issue_counts = filtered_issues['tipo'].value_counts()
+    issue_counts = issue_counts[issue_counts > 0]
+    if not issue_counts.empty:
+        issue_texts = {
+            'Hodômetro regrediu': "leitura(s) de KM menor(es) que a anterior do mesmo veículo.",
+            'Viagens sobrepostas': "saída(s) com o veículo ainda em outra viagem.",
+            'Velocidade implausível': f"viagem(ns) acima de {MAX_SPEED_KMH} km/h de média.",
+        }
+        for column, (tipo, count) in zip(st.columns(len(ISSUE_TYPES)), issue_counts.items()):
+            column.markdown(f"""
+            <div class="warning-card">
+                <strong>🧪 {tipo}:</strong> {count} {issue_texts[tipo]}
+            </div>
+            """, unsafe_allow_html=True)
+
     if not filtered_trips.empty:
-        st.markdown('<div class="section-header">📈 Análises e Tendências</div>', unsafe_allow_html=True)
+        # Gráficos e utilização ficam com o espaço reservado e só são montados depois
+        # das tabelas: no primeiro acesso do processo o plotly ainda precisa ser importado
+        charts_area = st.container()
+        charts_area.markdown('<div class="section-header">📈 Análises e Tendências</div>', unsafe_allow_html=True)
+        utilization_area = st.container()
+        utilization_area.markdown('<div class="section-header">🚦 Utilização da Frota</div>', unsafe_allow_html=True)
 
-        col1, col2 = st.columns(2)
+        # Tabela detalhada
+        st.markdown('<div class="section-header">📋 Detalhamento das Viagens</div>', unsafe_allow_html=True)
 
-        with col1:
-            # Viagens por dia
-            viagens_por_dia = filtered_trips.groupby(filtered_trips['data_saida'].dt.date).size().reset_index()
-            viagens_por_dia.columns = ['Data', 'Viagens']
+        trip_columns = {
+            'motorista': 'Motorista',
+            'placa': 'Placa',
+            'modelo': 'Modelo',
+            'data_saida': 'Data/Hora Saída',
+            'data_chegada': 'Data/Hora Chegada',
+            'km_inicial': st.column_config.NumberColumn('KM Inicial', format='%d'),
+            'km_final': st.column_config.NumberColumn('KM Final', format='%d'),
+            'km_rodados': st.column_config.NumberColumn('KM Rodados', format='%d'),
+            'tempo_viagem': st.column_config.NumberColumn('Tempo (min)', format='%d'),
+            'finalidade': 'Finalidade',
+            'status': 'Status'
+        }
+        render_paginated_table(filtered_trips, trip_columns, key='viagens', default_sort='data_saida')
+        render_export_buttons(filtered_trips, trip_columns, key='viagens', file_stem='viagens')
 
-            fig_viagens = px.line(
-                viagens_por_dia,
-                x='Data',
-                y='Viagens',
-                title='Viagens por Dia',
-                color_discrete_sequence=['#F7931E']
-            )
-            fig_viagens.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                font=dict(color='#000000')
-            )
-            st.plotly_chart(fig_viagens, use_container_width=True)
-
-        with col2:
-            # Distribuição por motorista
-            viagens_motorista = filtered_trips['motorista'].value_counts().reset_index()
-            viagens_motorista.columns = ['Motorista', 'Viagens']
-
-            fig_motorista = px.bar(
-                viagens_motorista,
-                x='Viagens',
-                y='Motorista',
-                orientation='h',
-                title='Viagens por Motorista',
-                color_discrete_sequence=['#F7931E']
-            )
-            fig_motorista.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                font=dict(color='#000000')
-            )
-            st.plotly_chart(fig_motorista, use_container_width=True)
+        # Tabela de chegadas órfãs (se houver)
+        if not orphan_arrivals.empty:
+            st.markdown('<div class="section-header">🔍 Chegadas Órfãs (Sem Saída Correspondente)</div>',
+                        unsafe_allow_html=True)
 
-        col3, col4 = st.columns(2)
+            orphan_columns = {
+                'motorista': 'Motorista',
+                'placa': 'Placa',
+                'modelo': 'Modelo',
+                'data_chegada': 'Data/Hora Chegada',
+                'km_final': st.column_config.NumberColumn('KM Final', format='%d'),
+                'status': 'Status'
+            }
+            render_paginated_table(orphan_arrivals, orphan_columns, key='orfas', default_sort='data_chegada')
+            render_export_buttons(orphan_arrivals, orphan_columns, key='orfas', file_stem='chegadas_orfas')
 
-        with col3:
-            # KM por finalidade
-            km_finalidade = filtered_trips.groupby('finalidade')['km_rodados'].sum().reset_index()
+        # Tabela de ocorrências de qualidade (se houver)
+        if not filtered_issues.empty:
+            st.markdown('<div class="section-header">🧪 Qualidade dos Dados (Hodômetro, Sobreposições, Velocidade)</div>',
+                        unsafe_allow_html=True)
 
-            fig_km = px.pie(
-                km_finalidade,
-                values='km_rodados',
-                names='finalidade',
-                title='KM por Finalidade',
-                color_discrete_sequence=px.colors.sequential.Oranges_r
-            )
-            fig_km.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                font=dict(color='#000000')
-            )
-            st.plotly_chart(fig_km, use_container_width=True)
-
-        with col4:
-            # Horários de maior movimento
-            filtered_trips['hora_saida'] = filtered_trips['data_saida'].dt.hour
-            movimentos_hora = filtered_trips['hora_saida'].value_counts().sort_index().reset_index()
-            movimentos_hora.columns = ['Hora', 'Viagens']
-
-            fig_hora = px.bar(
-                movimentos_hora,
-                x='Hora',
-                y='Viagens',
-                title='Movimentação por Hora',
-                color_discrete_sequence=['#F7931E']
+            issue_columns = {
+                'tipo': 'Ocorrência',
+                'placa': 'Placa',
+                'motorista': 'Motorista',
+                'data': 'Data/Hora',
+                'detalhe': 'Detalhe',
+            }
+            render_paginated_table(filtered_issues, issue_columns, key='qualidade', default_sort='data')
+            render_export_buttons(filtered_issues, issue_columns, key='qualidade', file_stem='qualidade_dados')
+
+        with charts_area:
+            with st.spinner("📈 Montando gráficos..."):
+                figures = load_figures(version, data_inicio, data_fim, motoristas_selecionados,
+                                       status_selecionado, slices)
+
+            col1, col2 = st.columns(2)
+
+            with col1:
+                # Viagens por dia, semana ou mês
+                with timed('plotly', chart='viagens_por_periodo'):
+                    st.plotly_chart(figures['viagens_por_periodo'], width='stretch')
+
+            with col2:
+                # Distribuição por motorista
+                with timed('plotly', chart='viagens_motorista'):
+                    st.plotly_chart(figures['viagens_motorista'], width='stretch')
+
+            col3, col4 = st.columns(2)
+
+            with col3:
+                # KM por finalidade
+                with timed('plotly', chart='km_finalidade'):
+                    st.plotly_chart(figures['km_finalidade'], width='stretch')
+
+            with col4:
+                # Horários de maior movimento
+                with timed('plotly', chart='movimentos_hora'):
+                    st.plotly_chart(figures['movimentos_hora'], width='stretch')
+
+        with utilization_area:
+            utilization, utilization_figures = load_utilization(
+                version, data_inicio, data_fim, motoristas_selecionados, status_selecionado,
+                pd.Timestamp.now().floor('min'), trips_data
             )
-            fig_hora.update_layout(
-                plot_bgcolor='white',
-                paper_bgcolor='white',
-                font=dict(color='#000000')
+            por_placa = utilization['por_placa']
+
+            col_u1, col_u2, col_u3, col_u4 = st.columns(4)
+            col_u1.metric("Pico de Veículos Simultâneos", utilization['pico'])
+            col_u2.metric("Veículos em Uso Agora",
+                          utilization['em_uso_agora'] if utilization['em_uso_agora'] is not None else "—")
+            col_u3.metric("Utilização Média", f"{por_placa['utilizacao'].mean():.1f}%" if len(por_placa) else "—")
+            col_u4.metric("Veículos sem Viagens", int((por_placa['viagens'] == 0).sum()))
+
+            col5, col6 = st.columns(2)
+
+            with col5:
+                with timed('plotly', chart='veiculos_em_uso'):
+                    st.plotly_chart(utilization_figures['veiculos_em_uso'], width='stretch')
+
+            with col6:
+                with timed('plotly', chart='pico_dia'):
+                    st.plotly_chart(utilization_figures['pico_dia'], width='stretch')
+
+            render_paginated_table(
+                por_placa,
+                {
+                    'placa': 'Placa',
+                    'viagens': st.column_config.NumberColumn('Viagens', format='%d'),
+                    'horas_em_uso': st.column_config.NumberColumn('Horas em Uso', format='%.1f'),
+                    'utilizacao': st.column_config.ProgressColumn('Utilização (%)', format='%.1f%%',
+                                                                  min_value=0, max_value=100),
+                },
+                key='utilizacao',
+                default_sort='utilizacao'
             )
-            st.plotly_chart(fig_hora, use_container_width=True)
 
-        # Tabela detalhada
-        st.markdown('<div class="section-header">📋 Detalhamento das Viagens</div>', unsafe_allow_html=True)
+    else:
+        st.warning("Nenhum dado encontrado para os filtros selecionados.")
 
-        # Preparar dados para exibição
-        display_data = filtered_trips.copy()
-        if not display_data.empty:
-            display_data['data_saida'] = display_data['data_saida'].dt.strftime('%d/%m/%Y %H:%M')
-            display_data['data_chegada'] = display_data['data_chegada'].dt.strftime(
-                '%d/%m/%Y %H:%M') if 'data_chegada' in display_data.columns else None
-            display_data['tempo_viagem'] = display_data['tempo_viagem'].round(0).astype('Int64')
-            display_data['km_rodados'] = display_data['km_rodados'].astype('Int64')
-            display_data['km_inicial'] = display_data['km_inicial'].astype('Int64')
-            display_data['km_final'] = display_data['km_final'].astype('Int64')
-
-        st.dataframe(
-            display_data[['motorista', 'placa', 'modelo', 'data_saida', 'data_chegada',
-                          'km_inicial', 'km_final', 'km_rodados', 'tempo_viagem', 'finalidade', 'status']],
-            use_container_width=True,
-            column_config={
+    # Histórico completo de um motorista, veículo, e-mail ou modelo: sai direto do
+    # índice invertido, independente dos filtros da barra lateral
+    st.markdown('<div class="section-header">🔎 Histórico por Motorista ou Veículo</div>', unsafe_allow_html=True)
+    busca = st.text_input("Buscar motorista, placa, e-mail ou modelo",
+                          placeholder="Digite o início de um nome, placa ou e-mail")
+    if busca:
+        matches = search_trip_index(trip_index, busca)
+        if matches.empty:
+            st.info(f"Nenhum motorista, placa, e-mail ou modelo começa com \"{busca}\".")
+        else:
+            escolha = st.selectbox(
+                f"Resultados ({len(matches)})",
+                options=range(len(matches)),
+                format_func=lambda i: (f"{SEARCH_FIELDS[matches['campo'].iat[i]]}: {matches['valor'].iat[i]} "
+                                       f"({matches['viagens'].iat[i]} viagens)")
+            )
+            campo, valor = matches['campo'].iat[escolha], matches['valor'].iat[escolha]
+            with timed('historico', field=campo) as span:
+                history = trips_data.iloc[trip_positions(trip_index, campo, valor)]
+                span['rows'] = len(history)
+
+            col_h1, col_h2, col_h3, col_h4 = st.columns(4)
+            col_h1.metric("Viagens", len(history))
+            col_h2.metric("KM Rodados", f"{history['km_rodados'].sum():,.0f}")
+            col_h3.metric("Em Aberto", int((history['status'] == 'Em Aberto').sum()))
+            col_h4.metric("Período", f"{history['data_saida'].min():%d/%m/%Y} – {history['data_saida'].max():%d/%m/%Y}")
+
+            history_columns = {
                 'motorista': 'Motorista',
+                'email': 'E-mail',
                 'placa': 'Placa',
                 'modelo': 'Modelo',
                 'data_saida': 'Data/Hora Saída',
                 'data_chegada': 'Data/Hora Chegada',
-                'km_inicial': st.column_config.NumberColumn('KM Inicial', format='%d'),
-                'km_final': st.column_config.NumberColumn('KM Final', format='%d'),
                 'km_rodados': st.column_config.NumberColumn('KM Rodados', format='%d'),
                 'tempo_viagem': st.column_config.NumberColumn('Tempo (min)', format='%d'),
                 'finalidade': 'Finalidade',
                 'status': 'Status'
             }
-        )
+            render_paginated_table(history, history_columns, key='historico', default_sort='data_saida')
+            render_export_buttons(history, history_columns, key='historico',
+                                  file_stem=f"historico_{re.sub(r'[^a-z0-9]+', '_', search_key(valor)).strip('_')}")
 
-        # Tabela de chegadas órfãs (se houver)
-        if not orphan_arrivals.empty:
-            st.markdown('<div class="section-header">🔍 Chegadas Órfãs (Sem Saída Correspondente)</div>',
-                        unsafe_allow_html=True)
-
-            orphan_display = orphan_arrivals.copy()
-            orphan_display['data_chegada'] = orphan_display['data_chegada'].dt.strftime('%d/%m/%Y %H:%M')
-
-            st.dataframe(
-                orphan_display[['motorista', 'placa', 'modelo', 'data_chegada', 'km_final', 'status']],
-                use_container_width=True,
-                column_config={
-                    'motorista': 'Motorista',
-                    'placa': 'Placa',
-                    'modelo': 'Modelo',
-                    'data_chegada': 'Data/Hora Chegada',
-                    'km_final': st.column_config.NumberColumn('KM Final', format='%d'),
-                    'status': 'Status'
-                }
-            )
-
-    else:
-        st.warning("Nenhum dado encontrado para os filtros selecionados.")
+    if timing_panel is not None:
+        timing_panel.dataframe(get_timings().summary(), hide_index=True, width='stretch')
 
     # Footer
     st.markdown("---")
@@ -0,0 +1,241 @@
+"""Servidor Graph falso para testar e medir a sincronização do workbook offline
+
+Implementa apenas as rotas do Microsoft Graph usadas pelo dashboard:
+
+    GET /v1.0/sites/{host}:{path}
+    GET /v1.0/sites/{site_id}/drive/root/search(q='{nome}')
+    GET /v1.0/sites/{site_id}/drive/items/{item_id}          (eTag/cTag, 304)
+    GET /v1.0/sites/{site_id}/drive/items/{item_id}/content
+
+Com `throttle` > 0 as próximas requisições recebem 429 com Retry-After e
+`latency` atrasa cada download, simulando arquivos grandes.
+
+Uso:
+    python fake_graph_server.py --rows 100000 --append 500 --sources 3
+"""
+import argparse
+import hashlib
+import io
+import json
+import re
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote
+
+import pandas as pd
+
+from benchmark_pipeline import generate_form_rows, write_workbook
+
+SITE_ID = "fake-site"
+
+
+class FakeGraphServer:
+    """Servidor HTTP local que expõe workbooks como drive items
+
+    `files` mapeia nome do arquivo -> conteúdo; o primeiro é o padrão de
+    `filename`, `item_url` e set_content().
+    """
+
+    def __init__(self, files, host="127.0.0.1", port=0):
+        self.filename = next(iter(files))
+        self.requests = []
+        self.throttle = 0  # próximas N requisições recebem 429
+        self.latency = 0.0  # segundos de espera antes de cada download
+        self.items = {}
+        self._lock = threading.Lock()
+        for filename, content in files.items():
+            self.set_content(content, filename)
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server._handle(self)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._httpd = ThreadingHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1.0"
+
+    @property
+    def item_url(self):
+        return f"{self.base_url}/sites/{SITE_ID}/drive/items/{self.items[self.filename]['id']}"
+
+    @property
+    def content(self):
+        return self.items[self.filename]['content']
+
+    def set_content(self, content, filename=None):
+        """Trocar o conteúdo de um workbook, gerando novos eTag/cTag"""
+        filename = filename or self.filename
+        with self._lock:
+            item_id = self.items[filename]['id'] if filename in self.items else f"fake-item-{len(self.items)}"
+            digest = hashlib.sha1(content).hexdigest()
+            self.items[filename] = {
+                'id': item_id,
+                'content': content,
+                'sha256': hashlib.sha256(content).hexdigest().upper(),
+                'ctag': f'"c:{{{item_id}}},{digest[:12]}"',
+                'etag': f'"{{{item_id}}},{digest[:12]}"',
+                'last_modified': datetime.now(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    @staticmethod
+    def _item(filename, item):
+        return {
+            'id': item['id'],
+            'name': filename,
+            'eTag': item['etag'],
+            'cTag': item['ctag'],
+            'size': len(item['content']),
+            'lastModifiedDateTime': item['last_modified'],
+            'file': {
+                'mimeType': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+                'hashes': {'sha256Hash': item['sha256']},
+            },
+        }
+
+    def _handle(self, handler):
+        path = unquote(handler.path)
+        self.requests.append(path)
+
+        with self._lock:
+            if self.throttle > 0:
+                self.throttle -= 1
+                handler.send_response(429)
+                handler.send_header('Retry-After', '1')
+                handler.send_header('Content-Length', '0')
+                return handler.end_headers()
+
+            by_id = {item['id']: (filename, item) for filename, item in self.items.items()}
+
+        match = re.fullmatch(rf"/v1\.0/sites/{SITE_ID}/drive/items/([^/]+)(/content)?", path)
+        if match and match.group(1) in by_id:
+            filename, item = by_id[match.group(1)]
+            if match.group(2):
+                time.sleep(self.latency)  # fora do lock: downloads simultâneos
+                return self._send(handler, 200, item['content'], 'application/octet-stream')
+            if handler.headers.get('If-None-Match') == item['etag']:
+                return self._send(handler, 304, b'')
+            return self._send_json(handler, self._item(filename, item))
+
+        with self._lock:
+            match = re.fullmatch(rf"/v1\.0/sites/{SITE_ID}/drive/root/search\(q='(.*)'\)", path)
+            if match:
+                found = [self._item(filename, item) for filename, item in self.items.items()
+                         if match.group(1).lower() in filename.lower()]
+                return self._send_json(handler, {'value': found})
+
+            if re.fullmatch(r"/v1\.0/sites/[^/]+:/.*", path):
+                return self._send_json(handler, {'id': SITE_ID})
+
+        self._send_json(handler, {'error': {'code': 'itemNotFound'}}, status=404)
+
+    def _send_json(self, handler, payload, status=200):
+        self._send(handler, status, json.dumps(payload).encode(), 'application/json')
+
+    @staticmethod
+    def _send(handler, status, body, content_type=None):
+        handler.send_response(status)
+        if content_type:
+            handler.send_header('Content-Type', content_type)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        handler.wfile.write(body)
+
+
+def to_xlsx(df):
+    buffer = io.BytesIO()
+    write_workbook(df, buffer)
+    return buffer.getvalue()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=20000, help='linhas iniciais do workbook')
+    parser.add_argument('--append', type=int, default=200, help='linhas acrescentadas na segunda carga')
+    parser.add_argument('--sources', type=int, default=4, help='workbooks por filial na carga com várias fontes')
+    parser.add_argument('--latency', type=float, default=0.5, help='atraso (s) de cada download nas várias fontes')
+    args = parser.parse_args()
+
+    # O pipeline lê st.secrets (snapshots, log de tempos): rode a partir da pasta com .streamlit/secrets.toml
+    import controledeentradaesaidaveiculos as app
+
+    rows = generate_form_rows(args.rows)
+    server = FakeGraphServer({'Controle.xlsx': to_xlsx(rows)}).start()
+    client = app.GraphClient(lambda: {'access_token': 'fake', 'token_source': 'fake'}, base_url=server.base_url)
+    states = [{'lock': threading.Lock()}]
+
+    def timed(label):
+        started = time.perf_counter()
+        site_id = client.site_id('fake.sharepoint.com', '/sites/frota')
+        item_id, _ = client.find_items(site_id, server.filename)[0]
+        events = app.sync_workbook(client, f"{client.base_url}/sites/{site_id}/drive/items/{item_id}", states[-1])
+        print(f"{label:<32} {time.perf_counter() - started:8.3f}s  {len(events)} eventos")
+        return events
+
+    def timed_sources(label, sources, workers):
+        app.SOURCE_WORKERS = workers
+        started = time.perf_counter()
+        events = app.fetch_sharepoint_events(client, {'lock': threading.Lock(), 'items': {}}, sources)
+        print(f"{label:<32} {time.perf_counter() - started:8.3f}s  {len(events)} eventos")
+        return events
+
+    try:
+        timed('carga inicial')
+        timed('sem alterações (304)')
+
+        server.throttle = 2
+        timed('304 após dois 429')
+
+        # Processo novo (estado vazio): o snapshot em disco evita o download
+        states.append({'lock': threading.Lock()})
+        timed('partida a frio (snapshot)')
+
+        appended = generate_form_rows(args.append, start=datetime(2030, 1, 1), seed=1)
+        server.set_content(to_xlsx(pd.concat([rows, appended], ignore_index=True)))
+        delta = timed('linhas acrescentadas')
+
+        full = app.normalize_events(pd.read_excel(io.BytesIO(server.content)))
+        pd.testing.assert_frame_equal(delta, full)
+        print('eventos após o delta idênticos a uma carga completa')
+
+        # Várias fontes: um workbook por filial e ano, casados por glob, com downloads lentos
+        server.latency = args.latency
+        for workers, year in [(1, 2025), (app.SOURCE_WORKERS, 2026)]:
+            branch_rows = [generate_form_rows(args.rows // args.sources, seed=year * 10 + i)
+                           for i in range(args.sources)]
+            # A filial 1 repete respostas da filial 0 (cópia entre planilhas)
+            branch_rows[1] = pd.concat([branch_rows[0].head(100), branch_rows[1]], ignore_index=True)
+            for i, branch in enumerate(branch_rows):
+                server.set_content(to_xlsx(branch), f'Filial{i}_{year}.xlsx')
+
+            sources = [{'site_url': 'fake.sharepoint.com', 'site_path': '/sites/frota',
+                        'filename': f'Filial*_{year}.xlsx', 'label': None}]
+            merged = timed_sources(f'{args.sources} fontes, {workers} thread(s)', sources, workers)
+            assert len(merged) == sum(map(len, branch_rows)) - 100
+            assert merged[app.SOURCE_COLUMN].nunique() == args.sources
+        print('repetições entre fontes removidas; eventos marcados pela origem')
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
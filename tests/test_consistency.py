@@ -0,0 +1,99 @@
+"""Ocorrências de qualidade contra varreduras por força bruta
+
+Eventos pequenos e aleatórios, com motoristas embaralhados para que o
+mesmo veículo apareça em viagens sobrepostas: hodômetro, sobreposições e
+velocidades têm de bater com laços que comparam os pares diretamente.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+
+
+def random_events(rng, seed):
+    raw = generate_form_rows(int(rng.integers(5, 300)), vehicles=int(rng.integers(1, 6)),
+                             drivers=int(rng.integers(1, 8)), days=int(rng.integers(1, 15)),
+                             orphan_rate=rng.random() * 0.2, open_rate=rng.random() * 0.2, seed=seed)
+    events = app.apply_schema(app.normalize_events(raw), app.EVENT_SCHEMA)
+    # Motoristas trocados: Saídas de um veículo ficam com Chegadas de outro motorista
+    nomes = events['nome'].cat.categories
+    events['nome'] = pd.Categorical(rng.choice(nomes, len(events)), categories=nomes)
+    # Um décimo dos KM digitados errado, para cima ou para baixo
+    errado = rng.random(len(events)) < 0.1
+    events.loc[errado, 'km'] = (events.loc[errado, 'km'] + rng.integers(-80, 80, errado.sum())).clip(lower=0)
+    return events
+
+
+def brute_overlaps(trips):
+    """(placa, saída) das viagens que começam antes de alguma anterior do veículo terminar"""
+    found = set()
+    done = trips[trips['data_chegada'].notna()]
+    for placa, group in done.groupby('placa', observed=True):
+        group = group.sort_values('data_saida', kind='stable')
+        saidas, chegadas = list(group['data_saida']), list(group['data_chegada'])
+        for i in range(len(group)):
+            if any(saidas[i] < chegadas[j] for j in range(i)):
+                found.add((placa, saidas[i]))
+    return found
+
+
+def brute_regressions(events):
+    """(placa, data_hora) dos eventos com KM abaixo do evento anterior do veículo"""
+    found = []
+    with_km = events[events['km'].notna()]
+    for placa, group in with_km.groupby('placa', observed=True):
+        group = group.sort_values('data_hora', kind='stable')
+        km = list(group['km'])
+        for i in range(1, len(group)):
+            if km[i] < km[i - 1]:
+                found.append((placa, group['data_hora'].iloc[i]))
+    return sorted(found)
+
+
+@pytest.mark.parametrize('seed', range(150))
+def test_overlaps_and_regressions_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    events = random_events(rng, seed)
+    trips = app.pair_events(events)[0]
+
+    overlaps = app.overlapping_trips(trips)
+    assert set(zip(overlaps['placa'], overlaps['data'])) == brute_overlaps(trips)
+    assert len(overlaps) == len(brute_overlaps(trips))
+
+    regressions = app.odometer_regressions(events)
+    assert sorted(zip(regressions['placa'], regressions['data'])) == brute_regressions(events)
+
+
+@pytest.mark.parametrize('seed', range(50))
+def test_implausible_speeds_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    trips = app.pair_events(random_events(rng, seed))[0]
+
+    expected = set()
+    for saida, km, minutos in zip(trips['data_saida'], trips['km_rodados'], trips['tempo_viagem']):
+        if pd.notna(km) and km > 0 and pd.notna(minutos) and (minutos <= 0 or km / (minutos / 60) > app.MAX_SPEED_KMH):
+            expected.add(saida)
+    assert set(app.implausible_speeds(trips)['data']) == expected
+
+
+def test_known_overlap_is_reported_against_the_right_trip():
+    t0 = pd.Timestamp('2030-01-01 08:00')
+    events = app.apply_schema(pd.DataFrame({
+        'data_hora': [t0, t0 + pd.Timedelta('30min'), t0 + pd.Timedelta('2h'), t0 + pd.Timedelta('3h')],
+        'email': 'x@y', 'nome': ['A', 'B', 'A', 'B'], 'placa': 'ZZZ9Z99', 'modelo': 'Hilux',
+        'tipo': ['Saída', 'Saída', 'Chegada', 'Chegada'],
+        'km': [1000, 1050, 1100, 1040], 'finalidade': ['Obra', 'Obra', None, None],
+    }), app.EVENT_SCHEMA)
+    trips = app.pair_events(events)[0]
+
+    overlaps = app.overlapping_trips(trips)
+    assert list(overlaps['motorista']) == ['B']
+    assert overlaps['detalhe'].iloc[0] == 'Veículo ainda na viagem de A (01/01 08:00–01/01 10:00)'
+    assert list(app.odometer_regressions(events)['data']) == [t0 + pd.Timedelta('3h')]
@@ -0,0 +1,67 @@
+"""Exportação das tabelas: o que o download_button recebe do callable
+
+O callable de cada botão devolve export_file(...); o Streamlit passa esse
+valor por convert_data_to_bytes_and_infer_mime no clique, então o teste
+faz o mesmo caminho e relê o arquivo gerado.
+"""
+import io
+import os
+import sys
+import warnings
+
+import pandas as pd
+import pytest
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+
+LABELS = {
+    'motorista': 'Motorista',
+    'placa': 'Placa',
+    'data_saida': 'Data/Hora Saída',
+    'data_chegada': 'Data/Hora Chegada',
+    'km_rodados': 'KM Rodados',
+    'tempo_viagem': 'Tempo (min)',
+    'status': 'Status',
+}
+
+
+@pytest.fixture(scope='module')
+def trips():
+    events = app.apply_schema(app.normalize_events(generate_form_rows(600, seed=3)), app.EVENT_SCHEMA)
+    return app.pair_events(events)[0]
+
+
+def read_export(data, file_format):
+    if file_format == 'xlsx':
+        return pd.read_excel(io.BytesIO(data))
+    if file_format == 'csv':
+        return pd.read_csv(io.BytesIO(data), sep=';', encoding='utf-8-sig')
+    return pd.read_parquet(io.BytesIO(data))
+
+
+@pytest.mark.parametrize('file_format', list(app.EXPORT_FORMATS))
+def test_export_is_accepted_by_download_button(trips, file_format):
+    with warnings.catch_warnings():
+        warnings.simplefilter('error', ResourceWarning)
+        data = app.export_file(trips, LABELS, file_format, app.TimingRecorder())
+
+    converted, _ = convert_data_to_bytes_and_infer_mime(data, TypeError('Callable returned unsupported type'))
+    assert converted == data
+
+    exported = read_export(converted, file_format)
+    assert len(exported) == len(trips)
+    expected_columns = list(LABELS) if file_format == 'parquet' else list(LABELS.values())
+    assert list(exported.columns) == expected_columns
+
+
+def test_export_spans_rows_and_bytes(trips):
+    timings = app.TimingRecorder()
+    data = app.export_file(trips, LABELS, 'csv', timings)
+    span = timings.spans[-1]
+    assert span['stage'] == 'exportacao'
+    assert span['rows'] == len(trips)
+    assert span['bytes'] == len(data)
@@ -0,0 +1,73 @@
+"""Pareamento incremental (extend_trips) contra o pareamento completo
+
+Os eventos chegam em 2 a 4 lotes acrescentados; depois de todos, viagens,
+chegadas órfãs e estado de pareamento têm de ser os mesmos de um
+pair_events sobre todos os eventos. Os fluxos incluem linhas retroativas
+(respostas enviadas fora de ordem), empates de horário e Saídas
+repetidas.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+
+TRIP_ORDER = ['data_saida', 'motorista', 'placa', 'km_inicial', 'data_chegada']
+ORPHAN_ORDER = ['data_chegada', 'motorista', 'placa', 'km_final']
+PAIRING_ORDER = ['nome', 'placa']
+
+
+def random_events(rng, seed):
+    raw = generate_form_rows(int(rng.integers(5, 400)), vehicles=int(rng.integers(1, 5)),
+                             drivers=int(rng.integers(1, 6)), days=int(rng.integers(1, 10)),
+                             orphan_rate=rng.random() * 0.3, open_rate=rng.random() * 0.3, seed=seed)
+    events = app.normalize_events(raw)
+    if seed % 3 == 0:
+        # Um décimo das respostas vai para o fim: eventos retroativos nos lotes seguintes
+        late = rng.permutation(len(events))[:len(events) // 10]
+        events = pd.concat([events.drop(events.index[late]), events.iloc[late]], ignore_index=True)
+    data_hora, tipo = events.columns.get_loc('data_hora'), events.columns.get_loc('tipo')
+    if seed % 4 == 0:
+        # Empates: algumas respostas copiam o horário de outra
+        events.iloc[rng.integers(0, len(events), 5), data_hora] = \
+            events.iloc[rng.integers(0, len(events), 5), data_hora].to_numpy()
+    if seed % 5 == 0:
+        events.iloc[rng.integers(0, len(events), 3), tipo] = 'Saída'
+    return events
+
+
+def canonical(df, order):
+    df = df.copy()
+    for column in df.columns:
+        if isinstance(df[column].dtype, pd.CategoricalDtype):
+            df[column] = df[column].astype(object)
+    return df.sort_values(order, kind='stable', na_position='last').reset_index(drop=True)
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_extend_trips_matches_full_pairing(seed):
+    rng = np.random.default_rng(seed)
+    events = random_events(rng, seed)
+    cuts = sorted(set(rng.integers(0, len(events), int(rng.integers(1, 4))).tolist())) + [len(events)]
+
+    trips, orphans, pairing = app.pair_events(events.iloc[:cuts[0]])
+    trips = trips.sort_values('data_saida', kind='stable', ignore_index=True)
+    for base_len, cut in zip(cuts, cuts[1:]):
+        trips, orphans, pairing = app.extend_trips(events.iloc[:cut], base_len, trips, orphans, pairing)
+        assert trips['data_saida'].is_monotonic_increasing
+
+    full_trips, full_orphans, full_pairing = app.pair_events(events)
+    pd.testing.assert_frame_equal(canonical(trips, TRIP_ORDER), canonical(full_trips, TRIP_ORDER),
+                                  check_dtype=False)
+    pd.testing.assert_frame_equal(canonical(orphans, ORPHAN_ORDER), canonical(full_orphans, ORPHAN_ORDER),
+                                  check_dtype=False)
+    pd.testing.assert_frame_equal(canonical(pairing, PAIRING_ORDER), canonical(full_pairing, PAIRING_ORDER),
+                                  check_dtype=False)
+    for column, dtype in app.TRIP_SCHEMA.items():
+        assert str(trips[column].dtype) == str(full_trips[column].dtype) or dtype == 'category'
@@ -0,0 +1,106 @@
+"""Utilização da frota contra uma contagem minuto a minuto
+
+Viagens pequenas e aleatórias (com sobreposições e viagens em aberto): a
+curva horária, as horas por placa e os veículos em uso agora têm de bater
+com uma grade de minutos marcada viagem a viagem.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+
+BASE = pd.Timestamp('2025-01-01')
+PLACAS = ['A', 'B', 'C', 'D', 'E']
+MOTORISTAS = ['Ana', 'Bruno', 'Carla']
+STATUS = ['Completa', 'Em Aberto']
+
+
+def random_trips(rng):
+    n = int(rng.integers(0, 30))
+    saidas = BASE + pd.to_timedelta(rng.integers(-3 * 1440, 3 * 1440, n), unit='m')
+    chegadas = pd.Series(saidas + pd.to_timedelta(rng.integers(1, 600, n), unit='m'))
+    chegadas[rng.random(n) < 0.2] = pd.NaT
+    trips = pd.DataFrame({
+        'motorista': pd.Categorical(rng.choice(MOTORISTAS, n), categories=MOTORISTAS),
+        'placa': pd.Categorical(rng.choice(PLACAS[:4], n), categories=PLACAS),
+        'data_saida': saidas,
+        'data_chegada': chegadas.to_numpy(),
+    })
+    trips['status'] = pd.Categorical(np.where(trips['data_chegada'].isna(), 'Em Aberto', 'Completa'),
+                                     categories=STATUS)
+    return trips.sort_values('data_saida', kind='stable', ignore_index=True)
+
+
+def brute_force(trips, selected, window_start, window_end, now):
+    """Grade de minutos ocupados por placa; fins calculados com todas as viagens"""
+    window_end = min(window_end, now)
+    minutes = pd.date_range(window_start, window_end, freq='min', inclusive='left')
+    proxima = trips.groupby('placa', observed=True)['data_saida'].shift(-1)
+    ends = trips['data_chegada'].fillna(proxima.where(proxima < now, now)).fillna(now)
+
+    busy = {placa: np.zeros(len(minutes), bool) for placa in PLACAS}
+    for placa, saida, fim in zip(trips['placa'][selected], trips['data_saida'][selected], ends[selected]):
+        busy[placa] |= (minutes >= saida) & (minutes < fim)
+    concurrent = sum(grid.astype(int) for grid in busy.values())
+    curve = pd.Series(concurrent, index=minutes).groupby(minutes.floor('h')).max()
+    hours = {placa: grid.sum() / 60 for placa, grid in busy.items()}
+    now_in_use = int(sum(grid[-1] for grid in busy.values())) if len(minutes) else 0
+    return curve, hours, now_in_use
+
+
+@pytest.mark.parametrize('seed', range(150))
+def test_utilization_matches_minute_grid(seed):
+    rng = np.random.default_rng(seed)
+    trips = random_trips(rng)
+    now = BASE + pd.Timedelta(days=2, hours=int(rng.integers(0, 30)))
+    window_start = BASE + pd.Timedelta(hours=int(rng.integers(-20, 20)))
+    window_end = BASE + pd.Timedelta(days=3)
+    motoristas = None if seed % 2 else list(rng.choice(MOTORISTAS, int(rng.integers(1, 3)), replace=False))
+    status = [STATUS, ['Completa'], ['Em Aberto']][seed % 3]
+
+    selected_trips, ends = app.utilization_trips(trips, app.next_departures(trips), window_start, window_end,
+                                                 now, motoristas, status)
+    utilization = app.fleet_utilization(selected_trips, window_start, window_end, now, ends)
+
+    selected = trips['status'].isin(status)
+    if motoristas is not None:
+        selected &= trips['motorista'].isin(motoristas)
+    curve, hours, now_in_use = brute_force(trips, selected, window_start, window_end, now)
+
+    got = utilization['curva'].set_index('Momento')['Veículos']
+    assert len(got) == len(curve)
+    assert (got.reindex(curve.index).fillna(-1).astype(int) == curve).all()
+    got_hours = utilization['por_placa'].set_index('placa')['horas_em_uso']
+    for placa in PLACAS:
+        assert got_hours[placa] == pytest.approx(hours[placa], abs=0.051)
+    if window_end >= now:
+        assert utilization['em_uso_agora'] == now_in_use
+
+
+def test_open_trip_that_left_before_the_window_is_in_use_now():
+    now = BASE + pd.Timedelta(days=10, hours=12)
+    trips = pd.DataFrame({
+        'motorista': pd.Categorical(['Ana', 'Bruno', 'Bruno', 'Carla']),
+        'placa': pd.Categorical(['A', 'B', 'B', 'C']),
+        # A: em aberto há 8 dias; B: em aberto esquecida, mas o veículo saiu de novo
+        # antes da janela; C: saiu antes da janela e voltou dentro dela
+        'data_saida': [BASE + pd.Timedelta(days=2), BASE + pd.Timedelta(days=1), BASE + pd.Timedelta(days=2),
+                       BASE + pd.Timedelta(days=3)],
+        'data_chegada': [pd.NaT, pd.NaT, BASE + pd.Timedelta(days=2, hours=2), BASE + pd.Timedelta(days=4)],
+    }).sort_values('data_saida', kind='stable', ignore_index=True)
+    trips['status'] = pd.Categorical(np.where(trips['data_chegada'].isna(), 'Em Aberto', 'Completa'))
+
+    window_start, window_end = BASE + pd.Timedelta(days=3, hours=12), BASE + pd.Timedelta(days=11)
+    selected, ends = app.utilization_trips(trips, app.next_departures(trips), window_start, window_end, now,
+                                           None, STATUS)
+    utilization = app.fleet_utilization(selected, window_start, window_end, now, ends)
+
+    assert sorted(selected['placa']) == ['A', 'C']
+    assert utilization['em_uso_agora'] == 1
+    assert utilization['curva']['Veículos'].iloc[0] == 2
@@ -0,0 +1,76 @@
+"""KPIs do índice acumulado contra as viagens filtradas (filter_trips)
+
+Janelas aleatórias de período, motoristas e status: o total de viagens,
+KM, tempo médio e motoristas ativos de kpi_window tem de bater com o que
+sai de filter_trips para os mesmos filtros.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+
+STATUS_CHOICES = [['Completa', 'Em Aberto'], ['Completa'], ['Em Aberto'], []]
+
+
+@pytest.fixture(scope='module')
+def trips():
+    rows = generate_form_rows(6000, vehicles=20, drivers=40, days=120, seed=21)
+    events = app.apply_schema(app.normalize_events(rows), app.EVENT_SCHEMA)
+    return app.pair_events(events)[0].sort_values('data_saida', kind='stable', ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def kpi_index(trips):
+    return app.build_kpi_index(trips)
+
+
+def expected_kpis(filtered):
+    tempo = filtered['tempo_viagem'].astype('float64')
+    return {
+        'viagens': len(filtered),
+        'km_rodados': float(filtered['km_rodados'].fillna(0).sum()),
+        'tempo_medio': float(tempo.mean()) if tempo.notna().any() else 0.0,
+        'motoristas_ativos': filtered['motorista'].nunique(),
+    }
+
+
+def assert_kpis_match(got, expected):
+    assert got['viagens'] == expected['viagens']
+    assert got['motoristas_ativos'] == expected['motoristas_ativos']
+    assert got['km_rodados'] == pytest.approx(expected['km_rodados'])
+    assert got['tempo_medio'] == pytest.approx(expected['tempo_medio'], rel=1e-5)
+
+
+def test_random_windows_match_filter_trips(trips, kpi_index):
+    rng = np.random.default_rng(0)
+    names = list(trips['motorista'].cat.categories)
+    first = trips['data_saida'].min().normalize()
+
+    for i in range(300):
+        data_inicio = first + pd.Timedelta(days=int(rng.integers(-10, 130)))
+        data_fim = data_inicio + pd.Timedelta(days=int(rng.integers(0, 60)))
+        if i % 3 == 0:
+            motoristas = None
+        else:
+            motoristas = list(rng.choice(names + ['Ninguém'], int(rng.integers(0, 10)), replace=False))
+        status = STATUS_CHOICES[i % 4]
+
+        got = app.kpi_window(kpi_index, data_inicio.date(), data_fim.date(), motoristas, status)
+        filtered = app.filter_trips(trips, data_inicio.date(), data_fim.date(), motoristas, status)
+        assert_kpis_match(got, expected_kpis(filtered))
+
+
+def test_reversed_window_is_empty(trips, kpi_index):
+    meio = trips['data_saida'].min().normalize() + pd.Timedelta(days=60)
+    data_inicio, data_fim = meio.date(), (meio - pd.Timedelta(days=10)).date()
+
+    got = app.kpi_window(kpi_index, data_inicio, data_fim, None, STATUS_CHOICES[0])
+    assert app.filter_trips(trips, data_inicio, data_fim, None, STATUS_CHOICES[0]).empty
+    assert got == {'viagens': 0, 'km_rodados': 0.0, 'tempo_medio': 0.0, 'motoristas_ativos': 0}
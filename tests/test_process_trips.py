@@ -0,0 +1,129 @@
+"""Equivalência do pareamento vetorizado com o laço groupby/iterrows original
+
+`reference_process_trips` é o process_trips anterior à vetorização, mantido
+aqui como referência; os dois são comparados em fluxos de eventos
+aleatórios (semente fixa) com chegadas órfãs, saídas repetidas, KM ausente
+e linhas que não entram no pareamento.
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+
+
+def reference_process_trips(df):
+    """process_trips original: percorre cada (nome, placa) linha a linha"""
+    df['data_hora'] = pd.to_datetime(df['data_hora'], format='%d/%m/%Y %H:%M')
+    df = df.sort_values(['nome', 'placa', 'data_hora'])
+
+    trips = []
+    orphan_arrivals = []
+
+    for (nome, placa), group in df.groupby(['nome', 'placa']):
+        saida = None
+
+        for _, row in group.iterrows():
+            if row['tipo'] == 'Saída':
+                saida = row
+            elif row['tipo'] == 'Chegada':
+                if saida is not None:
+                    tempo_viagem = (row['data_hora'] - saida['data_hora']).total_seconds() / 60
+                    km_rodados = row['km'] - saida['km'] if row['km'] > saida['km'] else 0
+
+                    trips.append({
+                        'motorista': nome,
+                        'placa': placa,
+                        'modelo': saida['modelo'],
+                        'data_saida': saida['data_hora'],
+                        'data_chegada': row['data_hora'],
+                        'km_inicial': saida['km'],
+                        'km_final': row['km'],
+                        'km_rodados': km_rodados,
+                        'tempo_viagem': tempo_viagem,
+                        'finalidade': saida['finalidade'],
+                        'status': 'Completa'
+                    })
+                    saida = None
+                else:
+                    orphan_arrivals.append({
+                        'motorista': nome,
+                        'placa': placa,
+                        'modelo': row['modelo'],
+                        'data_chegada': row['data_hora'],
+                        'km_final': row['km'],
+                        'status': 'Chegada Órfã'
+                    })
+
+        if saida is not None:
+            trips.append({
+                'motorista': nome,
+                'placa': placa,
+                'modelo': saida['modelo'],
+                'data_saida': saida['data_hora'],
+                'data_chegada': None,
+                'km_inicial': saida['km'],
+                'km_final': None,
+                'km_rodados': None,
+                'tempo_viagem': None,
+                'finalidade': saida['finalidade'],
+                'status': 'Em Aberto'
+            })
+
+    return pd.DataFrame(trips), pd.DataFrame(orphan_arrivals)
+
+
+def random_events(rng, n):
+    """Fluxo de eventos no formato de process_trips, com poucos grupos para forçar colisões"""
+    nomes = [f'Motorista {i}' for i in range(rng.integers(1, 6))]
+    placas = [f'ABC{i}D{i}{i}' for i in range(rng.integers(1, 4))]
+    base = pd.Timestamp('2025-01-01')
+    rows = []
+    for _ in range(n):
+        tipo = rng.choice(['Saída', 'Chegada', 'Outro'], p=[0.48, 0.48, 0.04])
+        rows.append({
+            'data_hora': (base + pd.Timedelta(minutes=int(rng.integers(0, 3000)))).strftime('%d/%m/%Y %H:%M'),
+            'email': 'motorista@rezendeenergia.com.br',
+            'nome': rng.choice(nomes) if rng.random() > 0.03 else None,
+            'placa': rng.choice(placas),
+            'modelo': rng.choice(['Gol', 'Strada', 'Hilux']),
+            'tipo': tipo,
+            'km': float(rng.integers(0, 1000)) if rng.random() > 0.05 else np.nan,
+            'finalidade': rng.choice(['Manutenção', 'Vistoria']) if tipo == 'Saída' else None,
+        })
+    return pd.DataFrame(rows)
+
+
+def plain(df, columns):
+    """Colunas de `columns` com tipos simples (datas, float64 e object) para comparar"""
+    out = pd.DataFrame(index=range(len(df)))
+    for column in columns:
+        values = df[column].reset_index(drop=True)
+        if column.startswith('data_'):
+            out[column] = pd.to_datetime(values).astype('datetime64[ns]')
+        elif column.startswith(('km_', 'tempo_')):
+            out[column] = pd.to_numeric(values.astype(object), errors='coerce').astype('float64')
+        else:
+            out[column] = values.astype(object).where(values.notna(), None)
+    return out
+
+
+@pytest.mark.parametrize('seed', range(300))
+def test_process_trips_matches_reference(seed):
+    rng = np.random.default_rng(seed)
+    events = random_events(rng, int(rng.integers(1, 80)))
+
+    expected_trips, expected_orphans = reference_process_trips(events.copy())
+    trips, orphans = app.process_trips(events.copy())
+
+    for expected, actual in ((expected_trips, trips), (expected_orphans, orphans)):
+        assert len(actual) == len(expected)
+        if expected.empty:
+            continue
+        pd.testing.assert_frame_equal(plain(actual, expected.columns), plain(expected, expected.columns),
+                                      check_exact=False, rtol=1e-6)
@@ -0,0 +1,40 @@
+"""Leitura das fontes de [sharepoint] / [[sharepoint.sources]]"""
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+
+
+def test_single_workbook_without_sources():
+    sharepoint = {'site_url': 'empresa.sharepoint.com', 'site_path': '/sites/frota', 'excel_filename': 'Controle.xlsx'}
+    assert app.sharepoint_sources(sharepoint) == [
+        {'site_url': 'empresa.sharepoint.com', 'site_path': '/sites/frota', 'filename': 'Controle.xlsx',
+         'label': None}]
+
+
+def test_sources_with_their_own_site_url_only():
+    sharepoint = {'sources': [
+        {'site_url': 'norte.sharepoint.com', 'site_path': '/sites/frota', 'filename': 'Filial*.xlsx', 'label': 'Norte'},
+        {'site_url': 'sul.sharepoint.com', 'site_path': '/sites/frota', 'filename': 'Sul.xlsx'},
+    ]}
+    assert [source['site_url'] for source in app.sharepoint_sources(sharepoint)] == [
+        'norte.sharepoint.com', 'sul.sharepoint.com']
+
+
+def test_sources_fall_back_to_the_shared_site_url():
+    sharepoint = {'site_url': 'empresa.sharepoint.com', 'sources': [
+        {'site_path': '/sites/frota', 'filename': 'A.xlsx'},
+        {'site_url': 'outra.sharepoint.com', 'site_path': '/sites/frota', 'filename': 'B.xlsx'},
+    ]}
+    assert [source['site_url'] for source in app.sharepoint_sources(sharepoint)] == [
+        'empresa.sharepoint.com', 'outra.sharepoint.com']
+
+
+def test_missing_site_url_is_a_clear_error():
+    sharepoint = {'sources': [{'site_path': '/sites/frota', 'filename': 'A.xlsx', 'label': 'Norte'}]}
+    with pytest.raises(RuntimeError, match="Fonte 'Norte' sem site_url"):
+        app.sharepoint_sources(sharepoint)
@@ -0,0 +1,121 @@
+"""sync_workbook contra o servidor Graph falso (fake_graph_server)
+
+Cobre os caminhos da sincronização: 304 no If-None-Match, eTag novo com o
+mesmo cTag, linhas acrescentadas (só o delta é normalizado) e linhas
+editadas (recarga completa). Os snapshots vão para uma pasta temporária e
+os tempos para um TimingRecorder sem arquivo, então st.secrets não é lido.
+"""
+import io
+import os
+import sys
+import threading
+from datetime import datetime
+
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+from fake_graph_server import FakeGraphServer, to_xlsx  # noqa: E402
+
+
+@pytest.fixture
+def timings(monkeypatch, tmp_path):
+    monkeypatch.setattr(app, 'snapshot_path',
+                        lambda key: os.path.join(tmp_path, app.snapshot_schema_marker(), key))
+    recorder = app.TimingRecorder()
+    app.set_thread_timings(recorder)
+    yield recorder
+    app.set_thread_timings(None)
+
+
+@pytest.fixture
+def rows():
+    return generate_form_rows(500, seed=7)
+
+
+@pytest.fixture
+def server(rows):
+    server = FakeGraphServer({'Controle.xlsx': to_xlsx(rows)}).start()
+    yield server
+    server.stop()
+
+
+@pytest.fixture
+def client(server):
+    return app.GraphClient(lambda: {'access_token': 'fake', 'token_source': 'fake'}, base_url=server.base_url)
+
+
+def downloads(server):
+    return sum(path.endswith('/content') for path in server.requests)
+
+
+def full_load(server):
+    return app.normalize_events(pd.read_excel(io.BytesIO(server.content)))
+
+
+def test_first_sync_downloads_and_normalizes(server, client, timings):
+    state = {'lock': threading.Lock()}
+    events = app.sync_workbook(client, server.item_url, state)
+
+    pd.testing.assert_frame_equal(events, full_load(server))
+    assert downloads(server) == 1
+    assert state['ctag'] == server.items[server.filename]['ctag']
+
+
+def test_unchanged_etag_answers_304(server, client, timings):
+    state = {'lock': threading.Lock()}
+    events = app.sync_workbook(client, server.item_url, state)
+
+    assert app.sync_workbook(client, server.item_url, state) is events
+    assert downloads(server) == 1
+
+
+def test_new_etag_with_same_ctag_skips_the_download(server, client, timings):
+    state = {'lock': threading.Lock()}
+    events = app.sync_workbook(client, server.item_url, state)
+    # Só os metadados mudaram (ex.: arquivo renomeado): eTag novo, conteúdo igual
+    server.items[server.filename]['etag'] = '"{metadados},2"'
+
+    assert app.sync_workbook(client, server.item_url, state) is events
+    assert downloads(server) == 1
+    assert state['etag'] == '"{metadados},2"'
+
+
+def test_appended_rows_only_normalize_the_delta(server, client, timings, rows):
+    state = {'lock': threading.Lock()}
+    before = app.sync_workbook(client, server.item_url, state)
+    appended = generate_form_rows(40, start=datetime(2030, 1, 1), seed=8)
+    server.set_content(to_xlsx(pd.concat([rows, appended], ignore_index=True)))
+
+    events = app.sync_workbook(client, server.item_url, state)
+
+    pd.testing.assert_frame_equal(events, full_load(server))
+    assert events.attrs['appended_to'] == (before.attrs['source_hash'], len(before))
+    assert state['rows_seen'] == len(rows) + len(appended)
+    assert downloads(server) == 2
+
+
+def test_edited_rows_reload_everything(server, client, timings, rows):
+    state = {'lock': threading.Lock()}
+    app.sync_workbook(client, server.item_url, state)
+    edited = rows.copy()
+    edited.loc[10, 'KM Final'] = 999999
+    server.set_content(to_xlsx(edited))
+
+    events = app.sync_workbook(client, server.item_url, state)
+
+    pd.testing.assert_frame_equal(events, full_load(server))
+    assert 'appended_to' not in events.attrs
+    assert downloads(server) == 2
+
+
+def test_cold_start_reads_the_snapshot(server, client, timings):
+    events = app.sync_workbook(client, server.item_url, {'lock': threading.Lock()})
+
+    restarted = app.sync_workbook(client, server.item_url, {'lock': threading.Lock()})
+
+    pd.testing.assert_frame_equal(restarted, events)
+    assert downloads(server) == 1
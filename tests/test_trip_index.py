@@ -0,0 +1,86 @@
+"""Índice invertido das viagens contra varreduras booleanas
+
+As posições de cada valor e as buscas por prefixo têm de bater com
+máscaras e str.startswith sobre o frame inteiro; o filtro sem motoristas
+(None) tem de dar o mesmo que a lista com todos eles.
+"""
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import controledeentradaesaidaveiculos as app  # noqa: E402
+from benchmark_pipeline import generate_form_rows  # noqa: E402
+
+
+@pytest.fixture(scope='module')
+def trips():
+    rows = generate_form_rows(5000, vehicles=30, drivers=80, days=90, seed=23)
+    events = app.apply_schema(app.normalize_events(rows), app.EVENT_SCHEMA)
+    return app.pair_events(events)[0].sort_values('data_saida', kind='stable', ignore_index=True)
+
+
+@pytest.fixture(scope='module')
+def index(trips):
+    return app.build_trip_index(trips)
+
+
+def brute_search(trips, prefix):
+    """{(campo, valor): viagens} dos valores cujo texto ou uma palavra começa com o prefixo"""
+    found = {}
+    for field in app.SEARCH_FIELDS:
+        counts = trips[field].value_counts()
+        for value, count in counts[counts > 0].items():
+            key = app.search_key(value)
+            if any(term.startswith(prefix) for term in [key, *re.split(r'[\s.@_-]+', key)] if term):
+                found[(field, value)] = count
+    return found
+
+
+def test_positions_match_boolean_scans(trips, index):
+    for field in app.SEARCH_FIELDS:
+        for value in trips[field].cat.categories:
+            expected = np.flatnonzero((trips[field] == value).to_numpy())
+            np.testing.assert_array_equal(app.trip_positions(index, field, value), expected)
+        assert len(app.trip_positions(index, field, 'Valor inexistente')) == 0
+
+
+def test_random_prefixes_match_startswith_scan(trips, index):
+    rng = np.random.default_rng(0)
+    keys = [app.search_key(value) for field in app.SEARCH_FIELDS for value in trips[field].cat.categories]
+    for i in range(200):
+        key = keys[int(rng.integers(len(keys)))]
+        if i % 4 == 0:
+            prefix = ''.join(rng.choice(list('abcdejmoprs'), int(rng.integers(1, 3))))
+        else:
+            # Um pedaço que começa no início do valor ou de uma das palavras dele
+            words = [word for word in re.split(r'[\s.@_-]+', key) if word]
+            word = words[int(rng.integers(len(words)))] if i % 2 else key
+            prefix = word[:int(rng.integers(1, len(word) + 1))]
+
+        matches = app.search_trip_index(index, prefix.upper() if i % 3 == 0 else prefix, limit=None)
+        got = {(campo, valor): viagens for campo, valor, viagens in matches.itertuples(index=False)}
+        assert got == brute_search(trips, prefix)
+        assert list(matches['viagens']) == sorted(matches['viagens'], reverse=True)
+
+
+def test_accents_are_ignored(trips, index):
+    nome = next(value for value in trips['motorista'].cat.categories if app.search_key(value) != value.lower())
+    matches = app.search_trip_index(index, app.search_key(nome), limit=None)
+    assert ('motorista', nome) in set(zip(matches['campo'], matches['valor']))
+
+
+def test_all_drivers_as_none_matches_the_full_list(trips):
+    todos = list(trips['motorista'].cat.categories)
+    status = ['Completa', 'Em Aberto']
+    inicio, fim = trips['data_saida'].iloc[len(trips) // 4].date(), trips['data_saida'].iloc[-len(trips) // 4].date()
+
+    pd.testing.assert_frame_equal(app.filter_trips(trips, inicio, fim, None, status),
+                                  app.filter_trips(trips, inicio, fim, todos, status))
+    kpi_index = app.build_kpi_index(trips)
+    assert app.kpi_window(kpi_index, inicio, fim, None, status) == app.kpi_window(kpi_index, inicio, fim, todos, status)